@@ -18,6 +18,8 @@ CREATE TABLE IF NOT EXISTS "gov_info" (
   "num_scraped" INTEGER,
   "pdf_count" INTEGER,
   "sbc_count" INTEGER,
+  "scrape_claimed_by" TEXT,
+  "scrape_claimed_at" TEXT,
   UNIQUE(id_idcd_plant)
 );
 
@@ -33,15 +35,60 @@ CREATE TABLE IF NOT EXISTS "google_query_results" (
 );
 
 
--- temp table to hold scraped units from latest run
+-- completion ledger for units claimed by sbc_spider
+CREATE TABLE IF NOT EXISTS "scrape_ledger" (
+  "id_idcd_plant" TEXT NOT NULL,
+  "run_id" TEXT,
+  "status" TEXT,
+  "started_at" TEXT,
+  "finished_at" TEXT,
+  "num_requests" INTEGER,
+  UNIQUE(id_idcd_plant)
+);
+
+
+-- url templates that CrawlTrapMiddleware stopped following
+CREATE TABLE IF NOT EXISTS "crawl_traps" (
+  "run_id" TEXT,
+  "base_domain" TEXT,
+  "template" TEXT,
+  "reason" TEXT,
+  "example_url" TEXT,
+  "tripped_at" TEXT,
+  "num_dropped" INTEGER
+);
+
+-- per domain counters written by the DomainTelemetry extension during a crawl
+CREATE TABLE IF NOT EXISTS "crawl_telemetry" (
+  "run_id" TEXT,
+  "base_domain" TEXT,
+  "id_idcd_plant" TEXT,
+  "num_requests" INTEGER,
+  "num_responses" INTEGER,
+  "bytes" INTEGER,
+  "mean_latency" REAL,
+  "p95_latency" REAL,
+  "status_counts" TEXT,
+  "num_pdfs" INTEGER,
+  "max_depth" INTEGER,
+  "first_seen" TEXT,
+  "last_seen" TEXT,
+  "wall_time" REAL,
+  UNIQUE(run_id, base_domain)
+);
+
+-- pages scraped per unit, written by the spider or ingest_scrape_results.py
 CREATE TABLE IF NOT EXISTS "latest_scrape" (
+  "referring_url" TEXT,
+  "url" TEXT,
+  "base_domain" TEXT,
+  "file_type" TEXT,
   "id_idcd_plant" TEXT NOT NULL,
-  "is_scraped" INTEGER,
-  "num_scraped" INTEGER
+  "run_id" TEXT
 );
 
 
--- temp table to hold listing of scraped pdfs from latest run
+-- listing of scraped pdfs, written by the spider or ingest_scrape_results.py
 CREATE TABLE IF NOT EXISTS "scraped_pdfs" (
   'url' TEXT,
   'relative_filepath' TEXT,
@@ -58,5 +105,25 @@ CREATE TABLE IF NOT EXISTS "sbc_check" (
   'id_idcd_plant' TEXT NOT NULL,
   'path_to_pdf' TEXT,
   'is_pdf_sbc' INTEGER,
+  UNIQUE(id_idcd_plant, path_to_pdf)
+);
+
+-- SBC verdicts by file hash, so each distinct pdf is only parsed once;
+-- rows from an older classifier_version are ignored and rechecked
+CREATE TABLE IF NOT EXISTS "sbc_verdicts" (
+  'file_hash' TEXT PRIMARY KEY,
+  'is_pdf_sbc' INTEGER,
+  'classifier_version' INTEGER,
+  'checked_at' TEXT
+);
+
+-- pdfs the SBC check failed on (parse errors, timeouts); skipped on later runs
+CREATE TABLE IF NOT EXISTS "exceptions_sbc_check" (
+  'path_to_pdf' TEXT,
+  'exception' TEXT,
   UNIQUE(path_to_pdf)
-);
\ No newline at end of file
+);
+
+-- for fanning SBC verdicts out to every row with the same file
+CREATE INDEX IF NOT EXISTS scraped_pdfs_file_hash ON scraped_pdfs (file_hash);
+CREATE INDEX IF NOT EXISTS scraped_pdfs_path_to_pdf ON scraped_pdfs (path_to_pdf);
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""
+BENCHMARK THE TIERED SBC CHECK
+
+Times the tiered check in identify_sbc.py against the original full
+three page layout extraction on a corpus of pdfs, and reports the per-pdf
+speedup, which tier decided each pdf, and any pdf where the two disagree.
+The corpus is either the pdfs under the given paths or a random sample of
+scraped_pdfs from the database.
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import statistics
+import time
+
+from pdfminer.high_level import extract_text
+
+# import globals from local config
+import scrape_config as config
+from identify_sbc import SBC_TITLE, check_sbc_title
+DB = config.DB_PATH
+
+
+def full_layout_check(pdfpath, maxpages=3):
+    '''
+    The check before the tiers were added, as the baseline
+
+    Takes:
+    - string filepath to PDF
+    - int number of pages to check, default 3
+    Returns:
+    - boolean True if text is found, otherwise False
+    '''
+
+    return SBC_TITLE.lower() in extract_text(pdfpath, maxpages=maxpages).lower()
+
+
+def sample_corpus(dbconn, sample_size):
+    '''
+    Takes:
+    - active db connection
+    - int number of pdfs to sample
+    Returns:
+    - list of filepaths to pdfs that still exist on disk
+    '''
+
+    rows = dbconn.execute(
+        '''
+        SELECT DISTINCT path_to_pdf
+        FROM scraped_pdfs
+        WHERE path_to_pdf IS NOT NULL
+        ORDER BY RANDOM()
+        LIMIT ?;
+        ''',
+        (sample_size, ),
+    ).fetchall()
+
+    return [path for path, in rows if os.path.isfile(path)]
+
+
+def find_pdfs(paths):
+    '''
+    Takes:
+    - list of pdf files or directories to search for pdfs
+    Returns:
+    - list of filepaths to pdfs
+    '''
+
+    pdfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdfs.extend(sorted(glob.glob(os.path.join(path, '**', '*.pdf'), recursive=True)))
+        else:
+            pdfs.append(path)
+
+    return pdfs
+
+
+def time_check(check, pdfpath, maxpages):
+    '''
+    Takes:
+    - check function
+    - string filepath to PDF
+    - int number of pages to check
+    Returns:
+    - result of the check, or the exception it raised
+    - float seconds taken
+    '''
+
+    start = time.perf_counter()
+    try:
+        result = check(pdfpath, maxpages)
+    except Exception as e:
+        result = e
+
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(pdfs, maxpages=3):
+    '''
+    Takes:
+    - list of filepaths to pdfs
+    - int number of pages to check
+    Returns:
+    - list of dicts with timings, verdicts and deciding tier for each pdf
+    '''
+
+    results = []
+    for pdfpath in pdfs:
+        baseline, baseline_secs = time_check(full_layout_check, pdfpath, maxpages)
+        tiered, tiered_secs = time_check(check_sbc_title, pdfpath, maxpages)
+
+        if isinstance(tiered, Exception):
+            verdict, tier = tiered, 'exception'
+        else:
+            verdict, tier = tiered
+
+        results.append({
+            'path_to_pdf': pdfpath,
+            'baseline': baseline,
+            'tiered': verdict,
+            'tier': tier,
+            'baseline_secs': baseline_secs,
+            'tiered_secs': tiered_secs,
+        })
+
+    return results
+
+
+def summarize(results):
+    '''
+    Print totals, per-pdf speedup, tier counts and disagreements
+
+    Takes:
+    - list of dicts from run_benchmark
+    Returns:
+    - None
+    '''
+
+    checked = [r for r in results if r['tier'] != 'exception' and not isinstance(r['baseline'], Exception)]
+    if not checked:
+        print("no pdfs could be checked")
+        return
+
+    baseline_total = sum(r['baseline_secs'] for r in checked)
+    tiered_total = sum(r['tiered_secs'] for r in checked)
+    speedups = [r['baseline_secs'] / max(r['tiered_secs'], 1e-6) for r in checked]
+
+    print(f"{len(results)} pdfs, {len(checked)} checked by both, {len(results) - len(checked)} raised")
+    print(f"full layout: {baseline_total:.2f}s total, {baseline_total / len(checked) * 1000:.1f}ms per pdf")
+    print(f"tiered:      {tiered_total:.2f}s total, {tiered_total / len(checked) * 1000:.1f}ms per pdf")
+    print(f"speedup: {baseline_total / max(tiered_total, 1e-6):.1f}x overall, "
+          f"{statistics.median(speedups):.1f}x median per pdf")
+
+    for tier in ('metadata', 'first_page', 'layout'):
+        decided = [r for r in checked if r['tier'] == tier]
+        if decided:
+            print(f"  decided by {tier}: {len(decided)} pdfs, "
+                  f"{statistics.median(r['tiered_secs'] for r in decided) * 1000:.1f}ms median")
+
+    disagreements = [r for r in checked if r['baseline'] != r['tiered']]
+    print(f"{len(disagreements)} disagreements with the full layout check")
+    for r in disagreements:
+        print(f"  {r['path_to_pdf']}: full layout {r['baseline']}, tiered {r['tiered']} ({r['tier']})")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('paths', nargs='*',
+        help='pdf files or directories to benchmark (default: sample scraped_pdfs)')
+    parser.add_argument('--sample', type=int, default=200,
+        help='number of pdfs to sample from scraped_pdfs (default: 200)')
+    parser.add_argument('--maxpages', type=int, default=3,
+        help='number of pages to check (default: 3)')
+    args = parser.parse_args()
+
+    if args.paths:
+        pdfs = find_pdfs(args.paths)
+    else:
+        dbconn = sqlite3.connect(DB)
+        pdfs = sample_corpus(dbconn, args.sample)
+        dbconn.close()
+
+    summarize(run_benchmark(pdfs, args.maxpages))
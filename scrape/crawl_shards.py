@@ -0,0 +1,248 @@
+"""
+RUN THE SPIDER AS SEVERAL SHARDED PROCESSES
+
+One Scrapy process is limited to one core, so this module splits the
+units in gov_info into N shards by a hash of their start url domain and
+runs one crawler process per shard. Each shard gets its own file store,
+metadata directory and job directory, so shards never write to the same
+files. Job directories are made fresh for each run, so a new crawl never
+picks up requests left over from an old one; --resume continues a run
+that died. Once every shard has exited, the pdfs are moved into the main
+file store (keeping the content index pointed at them) and the metadata
+csvs are concatenated into one pair of csvs for ingest_scrape_results.py.
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import subprocess
+import sys
+
+from scrapy.settings import Settings
+
+# import globals from local config
+import scrape_config as config
+DATA_DIR = config.DATA_DIR
+SCRAPY_PDF_PATH = config.SCRAPY_PDF_PATH
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sbcscrape')
+# the scrapy project, for its settings and content index
+sys.path.insert(0, PROJECT_DIR)
+from sbcscrape.content_index import ContentIndex
+
+SHARD_PDF_PATH = os.path.join(SCRAPY_PDF_PATH, 'shards')
+SHARD_DATA_PATH = os.path.join(DATA_DIR, 'shards')
+SHARD_JOB_PATH = os.path.join(DATA_DIR, 'crawls')
+
+# must match the file names in sbcscrape/pipelines.py
+PDF_METADATA_NAME = "_pdfs_from_sbc_spider.csv"
+SCRAPE_METADATA_NAME = "_scrape_run_metadata.csv"
+SCRAPE_PARQUET_NAME = "_scrape_run_metadata.parquet"
+
+
+def shard_dirs(shard):
+    '''
+    Takes:
+    - int shard number
+    Returns:
+    - tuple of (file store, metadata dir) for the shard
+    '''
+
+    name = f"shard_{shard}"
+    return (
+        os.path.join(SHARD_PDF_PATH, name, ''),
+        os.path.join(SHARD_DATA_PATH, name, ''),
+    )
+
+
+def launch_shards(num_shards, run_dir, extra_settings):
+    '''
+    Start one `scrapy crawl` process per shard and wait for all of them
+
+    Takes:
+    - int number of shards
+    - string directory holding this run's shard job dirs
+    - list of extra "NAME=VALUE" settings passed to every shard
+    Returns:
+    - list of exit codes, one per shard
+    '''
+
+    procs = []
+    for shard in range(num_shards):
+
+        files_store, data_path = shard_dirs(shard)
+        jobdir = os.path.join(run_dir, f"shard_{shard}")
+        os.makedirs(data_path, exist_ok=True)
+
+        cmd = [
+            sys.executable, '-m', 'scrapy', 'crawl', 'sbc_spider',
+            '-a', f'shard={shard}',
+            '-a', f'num_shards={num_shards}',
+            '-s', f'FILES_STORE={files_store}',
+            '-s', f'SCRAPED_DATA_PATH={data_path}',
+            '-s', f'JOBDIR={jobdir}',
+            # pdfs end up in the main store once merged
+            '-s', f'SQLITE_PDF_ROOT={SCRAPY_PDF_PATH}',
+            '-s', f'LOG_FILE={os.path.join(data_path, "crawl.log")}',
+        ]
+        for setting in extra_settings:
+            cmd += ['-s', setting]
+
+        print(f"starting shard {shard} of {num_shards}, logging to {data_path}crawl.log")
+        procs.append(subprocess.Popen(cmd, cwd=PROJECT_DIR))
+
+    return [proc.wait() for proc in procs]
+
+
+def shard_settings(extra_settings):
+    '''
+    Takes:
+    - list of extra "NAME=VALUE" settings passed to every shard
+    Returns:
+    - scrapy Settings the shards ran with
+    '''
+
+    settings = Settings()
+    settings.setmodule('sbcscrape.settings', priority='project')
+    for setting in extra_settings:
+        name, value = setting.split('=', 1)
+        settings.set(name, value, priority='cmdline')
+    return settings
+
+
+def content_index_db(settings):
+    '''
+    Takes:
+    - scrapy Settings the shards ran with
+    Returns:
+    - string path to the content index the shards used, or None if it is off
+    '''
+
+    if not settings.getbool('CONTENT_INDEX_ENABLED'):
+        return None
+    return settings.get('CONTENT_INDEX_DB')
+
+
+def merge_files(num_shards, index=None):
+    '''
+    Move each shard's stored pdfs into the main file store, keeping their
+    relative paths (full/<hash>.pdf) so the metadata csvs stay valid, and
+    point the content index at the moved files
+
+    Takes:
+    - int number of shards
+    - ContentIndex the shards recorded their files in, or None
+    Returns:
+    - int number of files moved
+    '''
+
+    moved = 0
+    for shard in range(num_shards):
+        files_store = shard_dirs(shard)[0]
+        moves = []
+
+        for root, _, files in os.walk(files_store):
+            for name in files:
+                src = os.path.join(root, name)
+                dest = os.path.join(SCRAPY_PDF_PATH, os.path.relpath(src, files_store))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # names are url hashes, so an existing file is the same url
+                os.replace(src, dest)
+                moves.append((src, dest))
+
+        if index is not None:
+            index.move_paths(moves)
+        moved += len(moves)
+
+    return moved
+
+
+def merge_metadata(num_shards, timestamp):
+    '''
+    Concatenate the shards' metadata csvs into one pdf csv and one scrape
+    csv in DATA_DIR. Merged shard csvs are renamed with a .merged suffix
+    so running the merge again doesn't append them twice. Parquet files
+    are moved into one dataset directory.
+
+    Takes:
+    - int number of shards
+    - string timestamp for the merged file names
+    Returns:
+    - list of merged csv paths
+    '''
+
+    merged = []
+    for suffix in (PDF_METADATA_NAME, SCRAPE_METADATA_NAME):
+
+        out_path = os.path.join(DATA_DIR, timestamp + suffix)
+        with open(out_path, 'ab') as out:
+            for shard in range(num_shards):
+                data_path = shard_dirs(shard)[1]
+                for csv_path in sorted(glob.glob(os.path.join(data_path, '*' + suffix))):
+                    with open(csv_path, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                    os.replace(csv_path, csv_path + '.merged')
+
+        merged.append(out_path)
+
+    # parquet files can't be appended to each other; collect them in a
+    # directory, which pandas and pyarrow read as one dataset
+    out_dir = os.path.join(DATA_DIR, timestamp + SCRAPE_PARQUET_NAME)
+    for shard in range(num_shards):
+        data_path = shard_dirs(shard)[1]
+        for i, parquet_path in enumerate(sorted(glob.glob(os.path.join(data_path, '*' + SCRAPE_PARQUET_NAME)))):
+            os.makedirs(out_dir, exist_ok=True)
+            os.replace(parquet_path, os.path.join(out_dir, f"shard_{shard}_{i}.parquet"))
+    if os.path.isdir(out_dir):
+        merged.append(out_dir)
+
+    return merged
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--shards', type=int,
+        help='number of crawler processes (default: number of cores, or the '
+             'number of shards in the run being resumed)')
+    parser.add_argument('--resume', metavar='DIR',
+        help='job directory of an earlier run to continue instead of starting a new crawl')
+    parser.add_argument('--merge-only', action='store_true',
+        help='skip crawling and only merge existing shard outputs')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE',
+        help='extra scrapy setting passed to every shard')
+    args = parser.parse_args()
+
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+
+    num_shards = args.shards or os.cpu_count()
+    if args.resume:
+        resumed = len(glob.glob(os.path.join(args.resume, 'shard_*')))
+        if not resumed:
+            parser.error(f"no shard job dirs in {args.resume}")
+        if args.shards and args.shards != resumed:
+            parser.error(f"{args.resume} has {resumed} shards, not {args.shards}")
+        num_shards = resumed
+
+    if not args.merge_only:
+        run_dir = args.resume or os.path.join(SHARD_JOB_PATH, timestamp)
+        os.makedirs(run_dir, exist_ok=bool(args.resume))
+        exit_codes = launch_shards(num_shards, run_dir, args.set)
+        for shard, code in enumerate(exit_codes):
+            if code != 0:
+                print(f"shard {shard} exited with code {code}; continue the run with --resume {run_dir}")
+
+    settings = shard_settings(args.set)
+    index_db = content_index_db(settings)
+    index = ContentIndex(index_db) if index_db else None
+    print(f"moved {merge_files(num_shards, index)} pdfs into {SCRAPY_PDF_PATH}")
+    if index is not None:
+        index.close()
+    for path in merge_metadata(num_shards, timestamp):
+        print(f"merged metadata into {path}")
+    if settings.getbool('SQLITE_RESULTS_ENABLED'):
+        print(f"results are already in {settings.get('DB_PATH')}; don't run ingest_scrape_results.py on these csvs")
+    else:
+        print("update SCRAPE_METADATA and PDF_METADATA in scrape_config.py before ingesting")
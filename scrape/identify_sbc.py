@@ -7,23 +7,74 @@ If a pdf is an SBC form, it is copied to the SBC PDF directory for ease of
 transfer to MEPS analysts.
 """
 
+import csv
 import datetime
+import html
+import os
+import re
 import sqlite3
-import pandas as pd
-
-from multiprocessing import Pool
-from pdfminer.high_level import extract_text
-from urllib.parse import urlparse
+import sys
+import time
+
+from collections import deque
+from itertools import islice
+from io import StringIO
+from multiprocessing import Pipe, Process, TimeoutError
+from multiprocessing.connection import wait
+from pdfminer.converter import PDFPageAggregator, TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import PDFStream, resolve1
+from pdfminer.utils import decode_text
+
+try:
+    import resource
+except ImportError:
+    # no memory ceiling for the large pdf lane on Windows
+    resource = None
 
 # local config 
 import scrape_config as config
 
+# the scrapy project, for the content index it shares with the crawl
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sbcscrape'))
+from sbcscrape.content_index import ContentIndex
+
 # globals from the config
 DB = config.DB_PATH
 DATA_DIR = config.DATA_DIR
 SCRAPY_PDF_PATH = config.SCRAPY_PDF_PATH
 SBC_PDF_PATH = config.SBC_PDF_PATH
 SBC_TITLE = config.STANDARD_SBC_TITLE_TEXT
+CONTENT_INDEX_DB = config.CONTENT_INDEX_DB
+
+# bump this whenever is_pdf_sbc_form changes, so cached verdicts from the
+# old check are ignored and the pdfs are checked again
+CLASSIFIER_VERSION = 3
+
+# seconds a worker gets to check one pdf before it is killed and replaced
+CHECK_TIMEOUT = 20
+# restart each worker after this many pdfs, since pdfminer's memory grows
+MAX_TASKS_PER_WORKER = 100
+# write results every this many pdfs or seconds, whichever comes first
+WRITE_BATCH_SIZE = 50
+WRITE_INTERVAL = 30
+
+# pdfs at least this big (budget books, agendas) are checked in their own
+# lane: few workers, a longer deadline, a fresh worker for every pdf and
+# a ceiling on each worker's address space, so they can't OOM the machine
+# or hold up the rest
+LARGE_PDF_SIZE = 50 * 1024 * 1024
+LARGE_PDF_WORKERS = 1
+LARGE_PDF_TIMEOUT = 300
+LARGE_PDF_MEMORY_LIMIT = 4 * 1024 * 1024 * 1024
+
+# the title in XMP metadata
+XMP_TITLE = re.compile(rb'<dc:title>(.*?)</dc:title>', re.S)
+XML_TAG = re.compile(r'<[^>]*>')
 
 
 
@@ -41,16 +92,752 @@ def is_pdf_sbc_form(id_idcd_plant, pdfpath, maxpages=3):
     - boolean True if text is found, otherwise false
     '''
 
-    pdf_text = extract_text(pdfpath, maxpages=3).lower()
+    is_pdf_sbc, _ = check_sbc_title(pdfpath, maxpages)
+
+    return id_idcd_plant, pdfpath, is_pdf_sbc
+
+
+def check_sbc_title(pdfpath, maxpages=3):
+    '''
+    Look for the SBC title with a cascade of checks, cheapest first:
+    the document title, then the first page without layout analysis,
+    then up to maxpages with full layout analysis. The earlier tiers can
+    only confirm an SBC; only the last one can rule it out.
+
+    Takes:
+    - string filepath to PDF
+    - int number of pages to check, default 3
+    Returns:
+    - boolean True if text is found, otherwise false
+    - string tier that decided: 'metadata', 'first_page' or 'layout'
+    '''
+
+    title = SBC_TITLE.lower()
+
+    with open(pdfpath, 'rb') as f:
+
+        if b'%PDF-' not in f.read(1024):
+            raise ValueError(f"not a pdf: {pdfpath}")
+
+        # pdfminer reads from the open file as it goes: only the xref, the
+        # document metadata and the objects the first pages need are parsed
+        f.seek(0)
+        doc = PDFDocument(PDFParser(f))
+
+        if any(title in t for t in metadata_titles(doc)):
+            return True, 'metadata'
+
+        return check_pages(doc, title, maxpages)
+
+
+def check_pages(doc, title, maxpages):
+    '''
+    The page tiers of check_sbc_title
+
+    Takes:
+    - pdfminer PDFDocument
+    - string lowercased SBC title
+    - int number of pages to check
+    Returns:
+    - boolean True if text is found, otherwise false
+    - string tier that decided: 'first_page' or 'layout'
+    '''
+
+    # each page is only interpreted once; the first page is checked as
+    # drawn before paying for layout analysis, then every page is laid
+    # out and the text so far checked, the same text extract_text returns
+    laparams = LAParams()
+    rsrcmgr = PDFResourceManager()
+    raw_text = StringIO()
+    layout_text = StringIO()
+    raw_converter = TextConverter(rsrcmgr, raw_text, laparams=None)
+    layout_converter = TextConverter(rsrcmgr, layout_text, laparams=laparams)
+
+    for pageno, ltpage in enumerate(iter_pages(rsrcmgr, doc, maxpages)):
+
+        # words may run together without layout analysis, so only a hit
+        # on the first page means anything here
+        if pageno == 0:
+            raw_converter.receive_layout(ltpage)
+            if title in raw_text.getvalue().lower():
+                return True, 'first_page'
+
+        ltpage.analyze(laparams)
+        layout_converter.receive_layout(ltpage)
+        if title in layout_text.getvalue().lower():
+            return True, 'layout'
+
+    return False, 'layout'
+
+
+def metadata_titles(doc):
+    '''
+    Titles of the document itself: the /Title of the trailer's /Info
+    dict and the dc:title of the catalog's XMP metadata. Other /Title
+    strings in the file (outline entries, annotations, form fields) name
+    parts of the document, not the document, so they aren't looked at.
+
+    Takes:
+    - pdfminer PDFDocument
+    Returns:
+    - generator of lowercased title strings
+    '''
+
+    for info in doc.info:
+        value = resolve1(info.get('Title'))
+        if isinstance(value, bytes):
+            yield ' '.join(decode_text(value).split()).lower()
+
+    metadata = resolve1(doc.catalog.get('Metadata'))
+    if not isinstance(metadata, PDFStream):
+        return
 
-    if "Glossary of Health Coverage and Medical Terms" in pdf_text:
-        return id_idcd_plant, pdfpath, False
+    # metadata we can't decode just means no answer from this tier
+    try:
+        xmp = metadata.get_data()
+    except Exception:
+        return
+
+    for match in XMP_TITLE.finditer(xmp):
+        text = html.unescape(XML_TAG.sub(' ', match.group(1).decode('utf-8', errors='ignore')))
+        yield ' '.join(text.split()).lower()
 
-    if SBC_TITLE.lower() in pdf_text:
-        return id_idcd_plant, pdfpath, True
-    
-    else:
-        return id_idcd_plant, pdfpath, False
+
+def iter_pages(rsrcmgr, doc, maxpages):
+    '''
+    Interpret pages one at a time without layout analysis
+
+    Takes:
+    - pdfminer PDFResourceManager
+    - pdfminer PDFDocument
+    - int number of pages to interpret
+    Returns:
+    - generator of pdfminer LTPage layouts, not yet analyzed
+    '''
+
+    device = PDFPageAggregator(rsrcmgr, laparams=None)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+    for page in islice(PDFPage.create_pages(doc), maxpages):
+        interpreter.process_page(page)
+        yield device.get_result()
+
+
+def available_cores():
+    '''
+    Returns:
+    - int number of cores this process may run on
+    '''
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def check_worker(conn, memory_limit=None):
+    '''
+    Worker loop: check each pdf sent down the pipe and send back the
+    verdict, or the exception as text, until sent None
+
+    Takes:
+    - worker end of a multiprocessing Pipe
+    - int ceiling on the worker's address space in bytes, or None
+    Returns:
+    - None
+    '''
+
+    # past the ceiling allocations fail with MemoryError, which is sent
+    # back like any other exception, instead of the OOM killer stepping in
+    if memory_limit and resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        id_idcd_plant, path_to_pdf = task
+        try:
+            _, _, is_pdf_sbc = is_pdf_sbc_form(id_idcd_plant, path_to_pdf)
+            conn.send((is_pdf_sbc, None))
+        except Exception as e:
+            conn.send((None, repr(e)))
+
+
+class SbcCheckPool(object):
+    '''
+    Worker processes for the SBC check, one pdf at a time each. Unlike a
+    multiprocessing Pool, a worker that runs past its deadline is killed
+    and replaced, so a hung parse gives up its slot instead of holding it
+    for the rest of the run. Workers that die are replaced too, and each
+    worker is restarted after maxtasks pdfs to cap pdfminer's memory.
+
+    pdfs of large_size bytes or more go to a separate lane of workers with
+    their own deadline and a memory ceiling, and each gets a fresh worker.
+    '''
+
+    def __init__(self, processes=None, timeout=CHECK_TIMEOUT, maxtasks=MAX_TASKS_PER_WORKER,
+                 large_size=LARGE_PDF_SIZE, large_processes=LARGE_PDF_WORKERS,
+                 large_timeout=LARGE_PDF_TIMEOUT, large_memory_limit=LARGE_PDF_MEMORY_LIMIT):
+        self.large_size = large_size
+        self.lanes = {
+            'default': {
+                'processes': processes or available_cores(),
+                'timeout': timeout,
+                'maxtasks': maxtasks,
+                'memory_limit': None,
+            },
+            'large': {
+                'processes': large_processes,
+                'timeout': large_timeout,
+                'maxtasks': 1,
+                'memory_limit': large_memory_limit,
+            },
+        }
+
+
+    def lane_for(self, path_to_pdf):
+        if not self.lanes['large']['processes']:
+            return 'default'
+        try:
+            if os.path.getsize(path_to_pdf) >= self.large_size:
+                return 'large'
+        except OSError:
+            pass
+        return 'default'
+
+
+    def start_worker(self, lane):
+        conn, worker_conn = Pipe()
+        process = Process(
+            target=check_worker,
+            args=(worker_conn, self.lanes[lane]['memory_limit'], ),
+            daemon=True,
+        )
+        process.start()
+        worker_conn.close()
+
+        return {'process': process, 'conn': conn, 'lane': lane, 'task': None, 'deadline': None, 'done': 0}
+
+
+    def stop_worker(self, worker, kill=False):
+        if kill:
+            worker['process'].kill()
+        else:
+            try:
+                worker['conn'].send(None)
+            except OSError:
+                pass
+        worker['process'].join()
+        worker['conn'].close()
+
+
+    def replace_worker(self, worker, kill=False):
+        self.stop_worker(worker, kill)
+        return self.start_worker(worker['lane'])
+
+
+    def send_task(self, worker, task, busy):
+        worker['conn'].send(task[1:])
+        worker['task'] = task
+        worker['deadline'] = time.monotonic() + self.lanes[worker['lane']]['timeout']
+        busy[worker['conn']] = worker
+
+
+    def run(self, tasks):
+        '''
+        Check pdfs across the workers
+
+        Takes:
+        - iterable of (key, gov unit ID, filepath to PDF) tuples
+        Returns:
+        - generator of (key, filepath to PDF, boolean verdict or None,
+          exception text or None) tuples, in the order they finish
+        '''
+
+        tasks = iter(tasks)
+        idle = {
+            lane: [self.start_worker(lane) for _ in range(settings['processes'])]
+            for lane, settings in self.lanes.items()
+        }
+        # large pdfs waiting for a large lane worker; while it is full,
+        # stop reading tasks so the rest of the run isn't pulled into memory
+        large_queue = deque()
+        large_queue_size = max(1, self.lanes['large']['processes'])
+        busy = {}
+
+        try:
+            while True:
+
+                # hand a pdf to every idle worker. large pdfs found on the
+                # way wait in their own queue for a large lane worker
+                while idle['default'] and len(large_queue) < large_queue_size:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    if self.lane_for(task[2]) == 'large':
+                        large_queue.append(task)
+                    else:
+                        self.send_task(idle['default'].pop(), task, busy)
+
+                while idle['large'] and large_queue:
+                    self.send_task(idle['large'].pop(), large_queue.popleft(), busy)
+
+                if not busy:
+                    break
+
+                # wait for a result, but no longer than the next deadline
+                next_deadline = min(worker['deadline'] for worker in busy.values())
+                for conn in wait(list(busy), timeout=max(0, next_deadline - time.monotonic())):
+                    worker = busy.pop(conn)
+                    key, _, path_to_pdf = worker['task']
+
+                    try:
+                        is_pdf_sbc, error = conn.recv()
+                    except EOFError:
+                        # the worker died mid-pdf, e.g. killed for memory
+                        worker['process'].join()
+                        error = repr(RuntimeError(f"worker exited with code {worker['process'].exitcode}"))
+                        idle[worker['lane']].append(self.replace_worker(worker, kill=True))
+                        yield key, path_to_pdf, None, error
+                        continue
+
+                    worker['done'] += 1
+                    if worker['done'] >= self.lanes[worker['lane']]['maxtasks']:
+                        worker = self.replace_worker(worker)
+                    idle[worker['lane']].append(worker)
+                    yield key, path_to_pdf, is_pdf_sbc, error
+
+                # kill and replace workers past their deadline
+                now = time.monotonic()
+                for conn, worker in list(busy.items()):
+                    if worker['deadline'] <= now:
+                        del busy[conn]
+                        key, _, path_to_pdf = worker['task']
+                        timeout = self.lanes[worker['lane']]['timeout']
+                        idle[worker['lane']].append(self.replace_worker(worker, kill=True))
+                        yield key, path_to_pdf, None, repr(TimeoutError(f"no verdict after {timeout}s"))
+
+        finally:
+            for workers in idle.values():
+                for worker in workers:
+                    self.stop_worker(worker)
+            for worker in busy.values():
+                self.stop_worker(worker, kill=True)
+
+
+def ensure_tables(dbconn):
+    '''
+    Create the tables this module writes to and the indexes the verdict
+    fan-out needs, for databases made before they were in the schema, and
+    migrate sbc_check from its old UNIQUE(path_to_pdf) constraint
+
+    Takes:
+    - active db connection
+    Returns:
+    - None
+    '''
+
+    dbconn.executescript(
+        '''
+        CREATE TABLE IF NOT EXISTS "sbc_check" (
+          'id_idcd_plant' TEXT NOT NULL,
+          'path_to_pdf' TEXT,
+          'is_pdf_sbc' INTEGER,
+          UNIQUE(id_idcd_plant, path_to_pdf)
+        );
+        CREATE TABLE IF NOT EXISTS "sbc_verdicts" (
+          'file_hash' TEXT PRIMARY KEY,
+          'is_pdf_sbc' INTEGER,
+          'classifier_version' INTEGER,
+          'checked_at' TEXT
+        );
+        CREATE TABLE IF NOT EXISTS "exceptions_sbc_check" (
+          'path_to_pdf' TEXT,
+          'exception' TEXT,
+          UNIQUE(path_to_pdf)
+        );
+        CREATE INDEX IF NOT EXISTS scraped_pdfs_file_hash ON scraped_pdfs (file_hash);
+        CREATE INDEX IF NOT EXISTS scraped_pdfs_path_to_pdf ON scraped_pdfs (path_to_pdf);
+        '''
+    )
+
+    if ['path_to_pdf'] in unique_indexes(dbconn, 'sbc_check'):
+        print("migrating sbc_check to UNIQUE(id_idcd_plant, path_to_pdf)")
+        with dbconn:
+            dbconn.executescript(
+                '''
+                BEGIN;
+                CREATE TABLE "sbc_check_migrated" (
+                  'id_idcd_plant' TEXT NOT NULL,
+                  'path_to_pdf' TEXT,
+                  'is_pdf_sbc' INTEGER,
+                  UNIQUE(id_idcd_plant, path_to_pdf)
+                );
+                INSERT OR IGNORE INTO sbc_check_migrated (id_idcd_plant, path_to_pdf, is_pdf_sbc)
+                SELECT id_idcd_plant, path_to_pdf, is_pdf_sbc
+                FROM sbc_check;
+                DROP TABLE sbc_check;
+                ALTER TABLE sbc_check_migrated RENAME TO sbc_check;
+                COMMIT;
+                '''
+            )
+
+
+def attach_content_index(dbconn, db_path):
+    '''
+    Attach the crawl's content index as content_index, so verdicts are
+    read from and written to the pdf_index table the crawl and every
+    other survey year use. Makes the index if no crawl has yet.
+
+    Takes:
+    - active db connection
+    - string path to CONTENT_INDEX_DB, or None to keep verdicts in this DB only
+    Returns:
+    - boolean True if the index was attached
+    '''
+
+    if not db_path:
+        return False
+
+    ContentIndex(db_path).close()
+    dbconn.execute('ATTACH DATABASE ? AS content_index;', (db_path, ))
+    return True
+
+
+def unique_indexes(dbconn, table):
+    '''
+    Takes:
+    - active db connection
+    - string table name
+    Returns:
+    - list of column lists, one per unique index or constraint on the table
+    '''
+
+    indexes = []
+    for _, name, unique, *_ in dbconn.execute(f"PRAGMA index_list('{table}')").fetchall():
+        if unique:
+            columns = dbconn.execute(f"PRAGMA index_info('{name}')").fetchall()
+            indexes.append([column for _, _, column in columns])
+    return indexes
+
+
+def apply_cached_verdicts(dbconn, content_index=False):
+    '''
+    Record cached verdicts for every unit and path whose file hash was
+    already checked by the current classifier version. With the content
+    index attached, verdicts from the crawl-time check (which have no
+    classifier version) and from other survey years are used too.
+
+    Takes:
+    - active db connection
+    - boolean True if the content index is attached
+    Returns:
+    - int number of rows added to sbc_check
+    '''
+
+    with dbconn:
+        cur = dbconn.execute(
+            '''
+            INSERT OR IGNORE INTO sbc_check (id_idcd_plant, path_to_pdf, is_pdf_sbc)
+            SELECT DISTINCT scraped_pdfs.id_idcd_plant,
+                    scraped_pdfs.path_to_pdf,
+                    sbc_verdicts.is_pdf_sbc
+            FROM scraped_pdfs
+            INNER JOIN sbc_verdicts
+            ON scraped_pdfs.file_hash=sbc_verdicts.file_hash
+            WHERE sbc_verdicts.classifier_version = ?;
+            ''',
+            (CLASSIFIER_VERSION, ),
+        )
+        num_rows = cur.rowcount
+
+        if content_index:
+            cur = dbconn.execute(
+                '''
+                INSERT OR IGNORE INTO sbc_check (id_idcd_plant, path_to_pdf, is_pdf_sbc)
+                SELECT DISTINCT scraped_pdfs.id_idcd_plant,
+                        scraped_pdfs.path_to_pdf,
+                        pdf_index.is_sbc
+                FROM scraped_pdfs
+                INNER JOIN content_index.pdf_index
+                ON scraped_pdfs.file_hash=pdf_index.checksum
+                WHERE pdf_index.is_sbc IS NOT NULL
+                    AND (pdf_index.classifier_version = ? OR pdf_index.classifier_version IS NULL);
+                ''',
+                (CLASSIFIER_VERSION, ),
+            )
+            num_rows += cur.rowcount
+
+    return num_rows
+
+
+def queue_pending_pdfs(dbconn):
+    '''
+    List the pdfs we haven't checked yet in a temp table, one row per
+    distinct file hash (or path, for rows without a hash), so they can be
+    read a page at a time instead of all at once
+
+    Takes:
+    - active db connection
+    Returns:
+    - int number of distinct files to check
+    '''
+
+    dbconn.execute('DROP TABLE IF EXISTS temp.pending_sbc_check;')
+    dbconn.execute(
+        '''
+        CREATE TEMP TABLE pending_sbc_check AS
+        WITH scraped_minus_exceptions AS (
+            SELECT scraped_pdfs.path_to_pdf,
+                scraped_pdfs.id_idcd_plant,
+                scraped_pdfs.file_hash
+            FROM scraped_pdfs
+            LEFT JOIN
+            exceptions_sbc_check
+            ON scraped_pdfs.path_to_pdf=exceptions_sbc_check.path_to_pdf
+            WHERE exception IS NULL
+        )
+        SELECT scraped_minus_exceptions.file_hash,
+                MIN(scraped_minus_exceptions.path_to_pdf) AS path_to_pdf,
+                scraped_minus_exceptions.id_idcd_plant
+        FROM scraped_minus_exceptions
+        LEFT JOIN sbc_check
+        ON scraped_minus_exceptions.id_idcd_plant=sbc_check.id_idcd_plant
+            AND scraped_minus_exceptions.path_to_pdf=sbc_check.path_to_pdf
+        WHERE is_pdf_sbc IS NULL
+        GROUP BY COALESCE(scraped_minus_exceptions.file_hash, scraped_minus_exceptions.path_to_pdf);
+        '''
+    )
+
+    return dbconn.execute('SELECT COUNT(*) FROM pending_sbc_check;').fetchone()[0]
+
+
+def iter_pending_pdfs(dbconn, page_size=1000):
+    '''
+    Takes:
+    - active db connection with the pending_sbc_check temp table
+    - int number of rows to read at a time
+    Returns:
+    - generator of ((file hash, filepath to PDF), gov unit ID, filepath to PDF)
+      tasks for SbcCheckPool; if the listed copy of a file is gone, another
+      copy of it is checked instead
+    '''
+
+    last_rowid = 0
+    while True:
+        rows = dbconn.execute(
+            '''
+            SELECT rowid, file_hash, id_idcd_plant, path_to_pdf
+            FROM pending_sbc_check
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?;
+            ''',
+            (last_rowid, page_size, ),
+        ).fetchall()
+
+        if not rows:
+            break
+
+        for last_rowid, file_hash, id_idcd_plant, path_to_pdf in rows:
+            if file_hash is not None and not os.path.isfile(path_to_pdf):
+                path_to_pdf = stored_copy(dbconn, file_hash) or path_to_pdf
+            yield (file_hash, path_to_pdf), id_idcd_plant, path_to_pdf
+
+
+def stored_copy(dbconn, file_hash):
+    '''
+    Takes:
+    - active db connection
+    - string file hash
+    Returns:
+    - string filepath to a copy of the file that is still on disk, or None
+    '''
+
+    rows = dbconn.execute(
+        '''
+        SELECT DISTINCT scraped_pdfs.path_to_pdf
+        FROM scraped_pdfs
+        LEFT JOIN
+        exceptions_sbc_check
+        ON scraped_pdfs.path_to_pdf=exceptions_sbc_check.path_to_pdf
+        WHERE file_hash = ? AND exception IS NULL
+        ORDER BY scraped_pdfs.path_to_pdf;
+        ''',
+        (file_hash, ),
+    ).fetchall()
+
+    for path_to_pdf, in rows:
+        if os.path.isfile(path_to_pdf):
+            return path_to_pdf
+    return None
+
+
+def save_verdicts(dbconn, verdicts, content_index=False):
+    '''
+    Cache newly reached verdicts by file hash, and with the content index
+    attached, record them for the files it knows so later crawls inherit
+    them
+
+    Takes:
+    - active db connection
+    - dict of file hash to boolean verdict
+    - boolean True if the content index is attached
+    Returns:
+    - None
+    '''
+
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+    dbconn.executemany(
+        '''
+        INSERT INTO sbc_verdicts (file_hash, is_pdf_sbc, classifier_version, checked_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(file_hash) DO UPDATE SET
+            is_pdf_sbc = excluded.is_pdf_sbc,
+            classifier_version = excluded.classifier_version,
+            checked_at = excluded.checked_at;
+        ''',
+        [(file_hash, int(verdict), CLASSIFIER_VERSION, now) for file_hash, verdict in verdicts.items()],
+    )
+
+    if content_index:
+        dbconn.executemany(
+            'UPDATE content_index.pdf_index SET is_sbc = ?, classifier_version = ? WHERE checksum = ?;',
+            [(int(verdict), CLASSIFIER_VERSION, file_hash) for file_hash, verdict in verdicts.items()],
+        )
+
+
+class SbcCheckWriter(object):
+    '''
+    Buffers verdicts and exceptions as workers finish and writes them in
+    one transaction every batch_size pdfs or interval seconds, so a crash
+    loses at most one batch and a rerun starts where this one stopped.
+    Each result is fanned out to every unit and path with the same file,
+    and appended to the results and exceptions csvs in DATA_DIR.
+    '''
+
+    # rows with this file, or just this path if there is no hash
+    same_file = '''
+            (scraped_pdfs.file_hash = :file_hash
+                OR (:file_hash IS NULL AND scraped_pdfs.path_to_pdf = :path_to_pdf))
+            '''
+
+    select_unchecked = f'''
+            SELECT DISTINCT scraped_pdfs.id_idcd_plant,
+                    scraped_pdfs.path_to_pdf
+            FROM scraped_pdfs
+            LEFT JOIN sbc_check
+            ON scraped_pdfs.id_idcd_plant=sbc_check.id_idcd_plant
+                AND scraped_pdfs.path_to_pdf=sbc_check.path_to_pdf
+            WHERE sbc_check.id_idcd_plant IS NULL
+                AND {same_file};
+            '''
+
+    select_paths = f'''
+            SELECT DISTINCT scraped_pdfs.path_to_pdf
+            FROM scraped_pdfs
+            WHERE {same_file};
+            '''
+
+    insert_check = '''
+            INSERT OR IGNORE INTO sbc_check (id_idcd_plant, path_to_pdf, is_pdf_sbc)
+            VALUES (?, ?, ?);
+            '''
+
+    insert_exception = '''
+            INSERT OR IGNORE INTO exceptions_sbc_check (path_to_pdf, exception)
+            VALUES (?, ?);
+            '''
+
+    def __init__(self, dbconn, results_path, exceptions_path, batch_size=WRITE_BATCH_SIZE, interval=WRITE_INTERVAL,
+                 content_index=False):
+        self.dbconn = dbconn
+        self.content_index = content_index
+        self.batch_size = batch_size
+        self.interval = interval
+        self.verdicts = []
+        self.exceptions = []
+        self.last_flush = time.monotonic()
+        self.num_results = 0
+        self.num_exceptions = 0
+
+        self.results_file = open(results_path, 'w', newline='')
+        self.results_csv = csv.writer(self.results_file)
+        self.results_csv.writerow(['id_idcd_plant', 'path_to_pdf', 'is_pdf_sbc'])
+        self.exceptions_file = open(exceptions_path, 'w', newline='')
+        self.exceptions_csv = csv.writer(self.exceptions_file)
+        self.exceptions_csv.writerow(['path_to_pdf', 'exception'])
+
+
+    def add_verdict(self, file_hash, path_to_pdf, is_pdf_sbc):
+        self.verdicts.append((file_hash, path_to_pdf, is_pdf_sbc))
+        self.maybe_flush()
+
+
+    def add_exception(self, file_hash, path_to_pdf, error):
+        self.exceptions.append((file_hash, path_to_pdf, error))
+        self.maybe_flush()
+
+
+    def maybe_flush(self):
+        pending = len(self.verdicts) + len(self.exceptions)
+        if pending >= self.batch_size or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Write everything buffered in one transaction
+        '''
+
+        results = []
+        exceptions = []
+
+        with self.dbconn:
+            for file_hash, path_to_pdf, is_pdf_sbc in self.verdicts:
+                rows = self.dbconn.execute(
+                    self.select_unchecked,
+                    {'file_hash': file_hash, 'path_to_pdf': path_to_pdf},
+                ).fetchall()
+                results.extend((id_idcd_plant, path, int(is_pdf_sbc)) for id_idcd_plant, path in rows)
+
+            # every path to a file that failed is skipped on later runs
+            for file_hash, path_to_pdf, error in self.exceptions:
+                rows = self.dbconn.execute(
+                    self.select_paths,
+                    {'file_hash': file_hash, 'path_to_pdf': path_to_pdf},
+                ).fetchall()
+                exceptions.extend((path, error) for path, in rows)
+
+            self.dbconn.executemany(self.insert_check, results)
+            self.dbconn.executemany(self.insert_exception, exceptions)
+            save_verdicts(self.dbconn, {
+                file_hash: is_pdf_sbc
+                for file_hash, _, is_pdf_sbc in self.verdicts
+                if file_hash is not None
+            }, self.content_index)
+
+        self.results_csv.writerows(results)
+        self.exceptions_csv.writerows(exceptions)
+        self.results_file.flush()
+        self.exceptions_file.flush()
+
+        self.num_results += len(results)
+        self.num_exceptions += len(exceptions)
+        self.verdicts = []
+        self.exceptions = []
+        self.last_flush = time.monotonic()
+
+
+    def close(self):
+        self.flush()
+        self.results_file.close()
+        self.exceptions_file.close()
 
 
 def update_gov_info_with_sbc_check(dbconn):
@@ -91,105 +878,50 @@ def update_gov_info_with_sbc_check(dbconn):
 if __name__ == "__main__":
 
     dbconn = sqlite3.connect(DB)
-
-    # get the paths to the PDFs we haven't checked yet
-    query = '''
-            WITH scraped_minus_exceptions AS (
-                SELECT scraped_pdfs.path_to_pdf,
-                    scraped_pdfs.id_idcd_plant
-                FROM scraped_pdfs
-                LEFT JOIN
-                exceptions_sbc_check
-                ON scraped_pdfs.path_to_pdf=exceptions_sbc_check.path_to_pdf
-                WHERE exception IS NULL
-            )
-            SELECT DISTINCT scraped_minus_exceptions.id_idcd_plant,
-                    scraped_minus_exceptions.path_to_pdf
-            FROM scraped_minus_exceptions
-            LEFT JOIN sbc_check
-            ON scraped_minus_exceptions.id_idcd_plant=sbc_check.id_idcd_plant
-                AND scraped_minus_exceptions.path_to_pdf=sbc_check.path_to_pdf 
-            WHERE is_pdf_sbc IS NULL;
-            '''
-
-    pdf_df = pd.read_sql(query, dbconn, coerce_float=False)
-
-    results = {
-        'id_idcd_plant': [],
-        'path_to_pdf': [],
-        'is_pdf_sbc': [],
-    }
-
-    exceptions = {
-        'path_to_pdf': [],
-        'exception': [],
-    }
+    ensure_tables(dbconn)
+    content_index = attach_content_index(dbconn, CONTENT_INDEX_DB)
 
     start_time = datetime.datetime.now()
 
-    # run parallel processes to check all the SBC forms
-    with Pool(processes=4) as pool:
-
-        futures = []
+    # the same file can be listed under several units and paths; files
+    # checked on an earlier run are filled in from the verdict cache, and
+    # each remaining file is parsed once and its verdict fanned out
+    print(f"{apply_cached_verdicts(dbconn, content_index)} pdfs filled in from cached verdicts")
+    print(f"{queue_pending_pdfs(dbconn)} distinct files to parse")
 
-        # iterate through each row of pdf df and set up parallel processes
-        # to check if each pdf is an SBC
-        for _, row in pdf_df.iterrows():
+    now =  datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    writer = SbcCheckWriter(
+        dbconn,
+        "{dir}results_df_{timestamp}.csv".format(dir=DATA_DIR, timestamp=now),
+        "{dir}exceptions_df_{timestamp}.csv".format(dir=DATA_DIR, timestamp=now),
+        content_index=content_index,
+    )
+
+    # check each file across the worker processes; timeouts and crashed
+    # workers come back as exceptions. whatever was checked is written
+    # even if the run is interrupted
+    try:
+        for (file_hash, _), f, is_pdf_sbc, error in SbcCheckPool().run(iter_pending_pdfs(dbconn)):
 
-            id_idcd_plant = row['id_idcd_plant']
-            path_to_pdf = row['path_to_pdf']
-            futures.append(
-                (path_to_pdf, \
-                pool.apply_async(is_pdf_sbc_form, (id_idcd_plant, path_to_pdf, )))
-            )
-    
-        # for each process, try to get the results and append to list for df
-        for f, fut in futures:
+            if error is None:
+                writer.add_verdict(file_hash, f, is_pdf_sbc)
 
-            try:
-                id_idcd_plant, path_to_pdf, is_pdf_sbc = fut.get(timeout = 20)
-                results['id_idcd_plant'].append(id_idcd_plant)
-                results['path_to_pdf'].append(path_to_pdf)
-                results['is_pdf_sbc'].append(is_pdf_sbc)
-            
-            except TimeoutError:
-                print('timeout checking pdf at location:', f)
-            
-            except Exception as e:
-                print('exception in sbc check:', e)
+            else:
+                print('exception in sbc check:', error)
                 print('pdf is', f)
 
-                exceptions['path_to_pdf'].append(f)
-                exceptions['exception'].append(e)
-
-    print('checking for SBCs took', (datetime.datetime.now() - start_time).total_seconds())
-
-    # when parallel is done, concat results in a dataframe
-    results_df = pd.DataFrame.from_dict(results)
-    exceptions_df = pd.DataFrame.from_dict(exceptions)
-
-    # sometimes this is null; assigning non-null default value so we can skip these
-    # in later queries. then we need to convert some exception objects into text
-    if exceptions_df.shape[0] > 0:
-        exceptions_df['exception'].fillna('0', inplace=True)
-        exceptions_df['exception'] = exceptions_df.apply(lambda x: x.exception.__repr__() if x.exception!='0' else x.exception, axis=1) 
+                # iter_pending_pdfs only hands over a missing path when no
+                # copy of the file is left, so the exception covers them all
+                writer.add_exception(file_hash, f, error)
 
-    try:
-
-        # write it to DB
-        results_df.to_sql('sbc_check', dbconn, index=False, if_exists='append')
-        exceptions_df.to_sql('exceptions_sbc_check', dbconn, index=False, if_exists='append')
+    finally:
+        writer.close()
 
         # update the main gov_info table
-        update_gov_info_with_sbc_check(dbconn)
-
-    except Exception as e:
-
-        print("Exception inserting data to SQL")
+        with dbconn:
+            update_gov_info_with_sbc_check(dbconn)
 
-    now =  datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    results_df.to_csv("{dir}results_df_{timestamp}.csv".format(dir=DATA_DIR, timestamp=now), index=False)
-    exceptions_df.to_csv("{dir}exceptions_df_{timestamp}.csv".format(dir=DATA_DIR, timestamp=now), index=False)
+    print('checking for SBCs took', (datetime.datetime.now() - start_time).total_seconds())
+    print(f"{writer.num_results} pdfs checked, {writer.num_exceptions} exceptions")
 
-    dbconn.commit()
-    dbconn.close()
\ No newline at end of file
+    dbconn.close()
@@ -20,6 +20,49 @@ SCRAPE_METADATA = config.SCRAPE_METADATA
 SCRAPY_PDF_PATH = config.SCRAPY_PDF_PATH
 
 
+def merge_on_domain(df, dbconn):
+    '''
+    Attach gov IDs to rows from csvs written before the spider stamped
+    id_idcd_plant on its output, by joining on the start url's domain.
+    This fans out when units share a domain and drops redirected hosts,
+    so it is only used for rows that have no ID.
+
+    Takes:
+    - active DB connection
+    - df of scraped rows with a base_domain column
+    Returns:
+    - df with id_idcd_plant and start_url from gov_info
+    '''
+
+    govs = pd.read_sql('SELECT id_idcd_plant, start_url FROM gov_info', dbconn)
+    govs['base_domain'] = govs['start_url'].apply(lambda x: urlparse(x).netloc if x else '')
+
+    df = df.drop(columns=['id_idcd_plant', 'start_url'])
+    return df.merge(govs, how='inner', on='base_domain')
+
+
+def attach_unit_ids(df, dbconn):
+    '''
+    Keep the gov IDs the spider recorded on each row, falling back to the
+    domain join only for older rows without one
+
+    Takes:
+    - df of scraped rows with id_idcd_plant and start_url columns
+    - active DB connection
+    Returns:
+    - df with an id_idcd_plant on every row that could be matched
+    '''
+
+    keyed = df[df['id_idcd_plant'].notna()]
+    legacy = df[df['id_idcd_plant'].isna()]
+
+    if legacy.empty:
+        return keyed
+
+    print(f"{legacy.shape[0]} rows have no gov ID; joining them on base domain")
+    return pd.concat([keyed, merge_on_domain(legacy, dbconn)], ignore_index=True)
+
+
 def ingest_pdf_list(dbconn, csv_path):
     '''
     Takes the csv containing list of scraped pdfs from Scrapy and ingest it
@@ -38,18 +81,16 @@ def ingest_pdf_list(dbconn, csv_path):
         'file_hash',
         'download_or_uptodate',
         'base_domain',
+        'id_idcd_plant',
+        'start_url',
     ]
-    pdf_df = pd.read_csv(csv_path, names=cols)
+    pdf_df = pd.read_csv(csv_path, names=cols, dtype={'id_idcd_plant': str})
 
 
     pdf_df['path_to_pdf'] = SCRAPY_PDF_PATH + pdf_df['relative_filepath']
 
-    # now join to find which entities we found pdfs for
-    govs = pd.read_sql('SELECT id_idcd_plant, start_url FROM gov_info', dbconn)
-    govs['base_domain'] = govs['start_url'].apply(lambda x: urlparse(x).netloc if x else '')
-
-    # join on gov info. watch out for dupes here!
-    pdf_df = pdf_df.merge(govs, how='inner', on='base_domain')
+    # the spider records which unit each pdf was found for
+    pdf_df = attach_unit_ids(pdf_df, dbconn)
 
     # save to temp table    
     pdf_df.to_sql('scraped_pdfs', dbconn, index=False, if_exists='append')
@@ -85,11 +126,12 @@ def ingest_scraped_metadata(dbconn, csv_path):
     '''
     Takes the metadata csv generated from Scrapy, which lists all websites
     scraped, and ingest it into the DB so we can track which sites have
-    been scraped already.
+    been scraped already. A .parquet path (from the spider's
+    ParquetPipeline) is read instead, loading only the columns we need.
 
     Takes:
     - active DB connection
-    - string filepath to metadata csv
+    - string filepath to metadata csv or parquet file
     Returns:
     - merged df of scraped listing with gov ID attached
     '''
@@ -99,15 +141,16 @@ def ingest_scraped_metadata(dbconn, csv_path):
         'url',
         'base_domain',
         'file_type',
+        'id_idcd_plant',
+        'start_url',
     ]
-    df = pd.read_csv(csv_path, names=cols)
-
-    # join on base domain to identify which units we scraped
-    govs = pd.read_sql('SELECT id_idcd_plant, start_url FROM gov_info', dbconn)
-    govs['base_domain'] = govs['start_url'].apply(lambda x: urlparse(x).netloc if x else '')
+    if csv_path.rstrip('/').endswith('.parquet'):
+        df = pd.read_parquet(csv_path, columns=cols)
+    else:
+        df = pd.read_csv(csv_path, names=cols, dtype={'id_idcd_plant': str})
 
-    # join on gov info. note there could be multiple rows per govt id now
-    merged_df = df.merge(govs, how='inner', on='base_domain').drop(columns=['start_url', ])
+    # the spider records which unit each page was scraped for
+    merged_df = attach_unit_ids(df, dbconn).drop(columns=['start_url', ])
 
     # do a check: are there cases where we can't merge on base domain?
     # try:
@@ -0,0 +1,160 @@
+"""
+Canonicalize urls so the same resource reached under different urls
+(host casing, session ids, tracking parameters, index pages) is only
+requested and stored once. Only used for request fingerprints by the
+dupefilter and the http cache; the url that is requested is left as it
+was linked, since folding case or dropping an index page is a guess
+about the server that can't be undone.
+"""
+
+import fnmatch
+import re
+import weakref
+
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+from scrapy.utils.request import RequestFingerprinter
+from w3lib.url import canonicalize_url
+
+
+# defaults; override with the CANONICAL_* settings
+DEFAULT_STRIP_PARAMS = [
+    'jsessionid',
+    'phpsessid',
+    'aspsessionid*',
+    'sessionid',
+    'cfid',
+    'cftoken',
+    'utm_*',
+    'fbclid',
+    'gclid',
+    'msclkid',
+    '_ga',
+]
+DEFAULT_INDEX_PAGES = [
+    'index.aspx',
+    'index.asp',
+    'index.html',
+    'index.htm',
+    'index.php',
+    'default.aspx',
+    'default.asp',
+    'default.htm',
+]
+# IIS treats paths and query keys case-insensitively, so documents served
+# by these handlers (e.g. ShowDocument.ashx?ID=12) are lowercased
+DEFAULT_CASE_INSENSITIVE_EXTENSIONS = ['.aspx', '.ashx', '.asp']
+
+# ;jsessionid=... and friends embedded in the path
+PATH_SESSION = re.compile(r';(jsessionid|phpsessid|sid)=[^/?#]*', re.IGNORECASE)
+# ASP.NET cookieless session segment, e.g. /(S(abc123))/page.aspx
+ASPNET_SESSION = re.compile(r'/\([A-Za-z]\([^)/]*\)\)', re.IGNORECASE)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class UrlCanonicalizer(object):
+    '''
+    Rewrites a url into its canonical form: lowercase scheme and host,
+    no default port, fragment or session ids, tracking parameters
+    removed, index pages without a query collapsed to their directory,
+    and the query sorted. Parameter names are matched case-insensitively
+    and may use shell wildcards (utm_*). Query values are never decoded,
+    so escapes that aren't utf-8 (?q=%E9) survive.
+    '''
+
+    def __init__(self, strip_params=None, index_pages=None, case_insensitive_extensions=None):
+        self.strip_params = [p.lower() for p in (strip_params or DEFAULT_STRIP_PARAMS)]
+        self.index_pages = set(p.lower() for p in (index_pages or DEFAULT_INDEX_PAGES))
+        self.case_insensitive_extensions = tuple(
+            e.lower() for e in (case_insensitive_extensions or DEFAULT_CASE_INSENSITIVE_EXTENSIONS)
+        )
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.getlist('CANONICAL_STRIP_PARAMS') or None,
+            settings.getlist('CANONICAL_INDEX_PAGES') or None,
+            settings.getlist('CANONICAL_CASE_INSENSITIVE_EXTENSIONS') or None,
+        )
+
+    def is_stripped(self, param):
+        param = param.lower()
+        return any(fnmatch.fnmatchcase(param, pattern) for pattern in self.strip_params)
+
+    def __call__(self, url):
+        return self.canonicalize(url)
+
+    def canonicalize(self, url):
+        '''
+        Takes:
+        - string url
+        Returns:
+        - string canonical url; urls that can't be parsed come back as is
+        '''
+
+        try:
+            parts = urlsplit(url.strip())
+            port = parts.port
+        except ValueError:
+            return url
+
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS:
+            return url
+
+        host = (parts.hostname or '').rstrip('.')
+        if ':' in host:
+            host = f"[{host}]"
+        netloc = host if port in (None, DEFAULT_PORTS[scheme]) else f"{host}:{port}"
+
+        path = ASPNET_SESSION.sub('', PATH_SESSION.sub('', parts.path)) or '/'
+        case_insensitive = path.lower().endswith(self.case_insensitive_extensions)
+
+        # filter the raw key=value pairs; only keys are decoded, to match
+        query = []
+        for pair in parts.query.split('&'):
+            key = pair.partition('=')[0]
+            if not pair or self.is_stripped(unquote_plus(key)):
+                continue
+            query.append(key.lower() + pair[len(key):] if case_insensitive else pair)
+
+        # with a query the index page is usually a handler (Index.aspx?ID=3)
+        head, _, last = path.rpartition('/')
+        if last.lower() in self.index_pages and not query:
+            path = head + '/'
+        if case_insensitive:
+            path = path.lower()
+
+        url = urlunsplit((scheme, netloc, path, '&'.join(query), ''))
+        # w3lib sorts the query and normalizes percent-encoding
+        return canonicalize_url(url)
+
+
+class CanonicalRequestFingerprinter(object):
+    '''
+    REQUEST_FINGERPRINTER_CLASS that fingerprints the canonical url, so
+    the dupefilter and http cache treat url variants as one request.
+    Everything else (method, body) is fingerprinted as Scrapy does.
+    '''
+
+    def __init__(self, canonicalizer, fingerprinter):
+        self.canonicalizer = canonicalizer
+        self.fingerprinter = fingerprinter
+        self.cache = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            UrlCanonicalizer.from_settings(crawler.settings),
+            RequestFingerprinter.from_crawler(crawler),
+        )
+
+    def fingerprint(self, request):
+        # the dupefilter, scheduler and cache all ask for the same request
+        if request not in self.cache:
+            canonical = self.canonicalizer(request.url)
+            if canonical == request.url:
+                self.cache[request] = self.fingerprinter.fingerprint(request)
+            else:
+                self.cache[request] = self.fingerprinter.fingerprint(request.replace(url=canonical))
+        return self.cache[request]
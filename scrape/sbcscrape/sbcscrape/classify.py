@@ -0,0 +1,126 @@
+"""
+Check whether a downloaded pdf is an SBC form while the crawl is running.
+
+This mirrors is_pdf_sbc_form in scrape/identify_sbc.py, which the spider
+can't import; identify_sbc.py is still the check of record.
+"""
+
+import re
+
+from io import BytesIO
+from pdfminer.high_level import extract_text
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import PDFObjRef, PDFStream
+
+
+# object number of the document catalog, so a truncated chunk can be
+# given the trailer it's missing
+CATALOG_OBJ = re.compile(rb'(\d+)\s+(\d+)\s+obj\s*<<(?:(?!endobj).)*?/Type\s*/Catalog\b', re.S)
+
+
+def is_pdf_sbc(pdf_file, sbc_title, maxpages=3):
+    '''
+    Check for presence of standard SBC title text
+
+    Takes:
+    - filepath or binary file object for the pdf
+    - string SBC title text
+    - int number of pages to check, default 3
+    Returns:
+    - boolean True if text is found, otherwise False
+    '''
+
+    pdf_text = extract_text(pdf_file, maxpages=maxpages).lower()
+
+    return sbc_title.lower() in pdf_text
+
+
+def is_pdf_chunk_sbc(chunk, sbc_title, maxpages=3):
+    '''
+    Check the first chunk of a pdf (e.g. from an HTTP Range request) for
+    the SBC title. The answer only decides whether the full file is worth
+    fetching; it is never recorded as the file's verdict. The chunk is cut back to its last complete object and
+    given a trailer pointing at the catalog so pdfminer can rebuild the
+    xref table. Objects past the end of the chunk raise, which callers
+    should treat as inconclusive.
+
+    Takes:
+    - bytes from the start of the pdf
+    - string SBC title text
+    - int number of pages to check, default 3
+    Returns:
+    - boolean True if text is found, otherwise False
+    '''
+
+    # uncompressed text or metadata may have the title as plain bytes
+    if sbc_title.lower().encode() in chunk.lower():
+        return True
+
+    end = chunk.rfind(b'endobj')
+    catalog = CATALOG_OBJ.search(chunk)
+    if end == -1 or catalog is None:
+        raise ValueError("chunk has no complete catalog object")
+
+    trailer = b'\ntrailer\n<< /Root %s %s R >>\n%%%%EOF\n' % catalog.groups()
+    repaired = chunk[:end + len(b'endobj')] + trailer
+
+    # pdfminer quietly skips missing objects, which would turn a cut-off
+    # page into a false "not an SBC"; only answer if the pages are whole
+    if not has_complete_pages(PDFDocument(PDFParser(BytesIO(repaired))), maxpages):
+        raise ValueError("chunk ends before the first pages are complete")
+
+    return is_pdf_sbc(BytesIO(repaired), sbc_title, maxpages)
+
+
+def has_complete_pages(doc, maxpages):
+    '''
+    Check that the first maxpages pages of a document, and every object
+    they reference (content streams, fonts, images), are present
+
+    Takes:
+    - pdfminer PDFDocument
+    - int number of pages that need to be complete
+    Returns:
+    - boolean True if nothing those pages need is missing
+    '''
+
+    known = set()
+    for xref in doc.xrefs:
+        known.update(xref.get_objids())
+
+    def is_complete(obj, seen):
+        if isinstance(obj, PDFObjRef):
+            if obj.objid in seen:
+                return True
+            if obj.objid not in known:
+                return False
+            seen.add(obj.objid)
+            obj = obj.resolve()
+        if isinstance(obj, PDFStream):
+            obj = obj.attrs
+        if isinstance(obj, dict):
+            return all(is_complete(v, seen) for k, v in obj.items() if k != 'Parent')
+        if isinstance(obj, list):
+            return all(is_complete(v, seen) for v in obj)
+        return True
+
+    try:
+        page_count = doc.catalog['Pages'].resolve()['Count']
+    except Exception:
+        return False
+
+    pages = 0
+    seen = set()
+    try:
+        for page in PDFPage.create_pages(doc):
+            if not is_complete(page.attrs, seen):
+                return False
+            pages += 1
+            if pages == maxpages:
+                break
+    except Exception:
+        return False
+
+    return pages == min(maxpages, page_count)
@@ -0,0 +1,141 @@
+"""
+Content-addressed index of stored pdfs, shared across runs and survey
+years. Maps each file checksum (the md5 FilesPipeline records) to the
+first place that content was stored and its SBC verdict, so the same pdf
+found under another url or in a later year is hardlinked instead of
+written again and isn't classified twice. identify_sbc.py reads and
+writes the same verdicts.
+"""
+
+import datetime
+import sqlite3
+
+
+class ContentIndex(object):
+    '''
+    Thin wrapper around the pdf_index table. The index lives in its own
+    database (CONTENT_INDEX_DB) rather than the per-year DB_PATH so that
+    every year's crawl can see it, and creates its table on first use.
+    '''
+
+    create = '''
+            CREATE TABLE IF NOT EXISTS "pdf_index" (
+              "checksum" TEXT PRIMARY KEY,
+              "path" TEXT,
+              "first_url" TEXT,
+              "first_seen" TEXT,
+              "is_sbc" INTEGER,
+              "classifier_version" INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS pdf_index_path ON pdf_index (path);
+            '''
+
+    upsert = '''
+            INSERT INTO pdf_index (
+                checksum,
+                path,
+                first_url,
+                first_seen
+            )
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(checksum) DO UPDATE SET
+                path = excluded.path;
+            '''
+
+    def __init__(self, db_path):
+        self.dbconn = sqlite3.connect(db_path, timeout=30)
+        self.dbconn.executescript(self.create)
+        self.ensure_columns()
+        self.dbconn.commit()
+
+
+    def ensure_columns(self):
+        '''
+        Add classifier_version to indexes made before it was in the table
+        '''
+
+        columns = [row[1] for row in self.dbconn.execute("PRAGMA table_info('pdf_index');")]
+        if 'classifier_version' not in columns:
+            self.dbconn.execute('ALTER TABLE pdf_index ADD COLUMN classifier_version INTEGER;')
+
+
+    def lookup(self, checksum):
+        '''
+        Takes:
+        - string checksum
+        Returns:
+        - tuple of (canonical path, is_sbc) or None if the content is new
+        '''
+
+        return self.dbconn.execute(
+            'SELECT path, is_sbc FROM pdf_index WHERE checksum = ?;',
+            (checksum, ),
+        ).fetchone()
+
+
+    def add(self, checksum, path, url):
+        '''
+        Record where this content is stored. Also used to move the
+        canonical path when the old copy has been deleted; first_url,
+        first_seen and the verdict are kept.
+        '''
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.dbconn.execute(self.upsert, (checksum, path, url, now, ))
+        self.dbconn.commit()
+
+
+    def verdicts(self, checksums):
+        '''
+        Takes:
+        - list of checksums
+        Returns:
+        - dict of checksum to boolean verdict, for checksums that have one
+        '''
+
+        checksums = list(checksums)
+        if not checksums:
+            return {}
+
+        placeholders = ', '.join('?' * len(checksums))
+        rows = self.dbconn.execute(
+            f'SELECT checksum, is_sbc FROM pdf_index WHERE is_sbc IS NOT NULL AND checksum IN ({placeholders});',
+            checksums,
+        ).fetchall()
+        return {checksum: bool(is_sbc) for checksum, is_sbc in rows}
+
+
+    def set_verdict(self, checksums, is_sbc, classifier_version=None):
+        '''
+        Record a verdict for content already in the index. Verdicts from
+        the crawl-time check have no classifier_version; identify_sbc.py
+        sets its CLASSIFIER_VERSION.
+        '''
+
+        self.dbconn.executemany(
+            'UPDATE pdf_index SET is_sbc = ?, classifier_version = ? WHERE checksum = ?;',
+            [(int(is_sbc), classifier_version, checksum) for checksum in checksums],
+        )
+        self.dbconn.commit()
+
+
+    def move_paths(self, moves):
+        '''
+        Point the index at files that were moved, e.g. from a shard's
+        file store into the main one
+
+        Takes:
+        - list of (old path, new path) tuples
+        Returns:
+        - None
+        '''
+
+        self.dbconn.executemany(
+            'UPDATE pdf_index SET path = ? WHERE path = ?;',
+            [(new, old) for old, new in moves],
+        )
+        self.dbconn.commit()
+
+
+    def close(self):
+        self.dbconn.close()
@@ -0,0 +1,533 @@
+# Define here the extensions used by the sbc spider
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.project import data_path
+from twisted.internet import defer, task
+from twisted.internet.error import DNSLookupError
+
+from sbcscrape.middlewares import get_base_domain
+from sbcscrape.spiders.sbc_spider import DB, shard_of
+
+# instantiate logger
+logger = logging.getLogger(__name__)
+
+
+class SlotState(object):
+    '''
+    Running latency and error averages for one downloader slot
+    '''
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.good_responses = 0
+
+
+class AdaptiveThrottle(object):
+    '''
+    Tunes concurrency and delay separately for each downloader slot
+    (i.e. each domain) from the latency and error rate we observe there.
+
+    - errors (timeouts, connection failures, 429 and 5xx responses) or
+      latency past ADAPTIVE_THROTTLE_SLOW_LATENCY halve concurrency and
+      double the delay
+    - latency above ADAPTIVE_THROTTLE_TARGET_LATENCY drops concurrency
+      by one and raises the delay a step
+    - otherwise, after as many good responses as the current concurrency,
+      add one to concurrency and shorten the delay
+
+    Decisions are kept in the crawl stats under adaptive_throttle/.
+    '''
+
+    ERROR_STATUSES = {429, 500, 502, 503, 504}
+
+    # weight of the newest sample in the running averages
+    ALPHA = 0.3
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 16)
+        self.min_delay = settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.0)
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 10.0)
+        self.delay_step = settings.getfloat('ADAPTIVE_THROTTLE_DELAY_STEP', 0.25)
+        self.target_latency = settings.getfloat('ADAPTIVE_THROTTLE_TARGET_LATENCY', 2.0)
+        self.slow_latency = settings.getfloat(
+            'ADAPTIVE_THROTTLE_SLOW_LATENCY',
+            settings.getfloat('DOWNLOAD_TIMEOUT') / 2,
+        )
+
+        self.slots = {}
+        self.downloaded = set()
+
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(self.request_left_downloader, signal=signals.request_left_downloader)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        if crawler.settings.getbool('AUTOTHROTTLE_ENABLED'):
+            logger.warning("AutoThrottle is also enabled; both will adjust download delays")
+        return cls(crawler)
+
+    def response_downloaded(self, response, request, spider):
+        # request_left_downloader fires next; anything it sees that isn't
+        # in this set never got a response
+        self.downloaded.add(id(request))
+
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.adjust(request, latency, response.status in self.ERROR_STATUSES)
+
+    def request_left_downloader(self, request, spider):
+        if id(request) in self.downloaded:
+            self.downloaded.discard(id(request))
+            return
+        self.adjust(request, None, True)
+
+    def adjust(self, request, latency, error):
+        '''
+        Update the slot's running averages with one sample and apply the
+        policy described on the class
+
+        Takes:
+        - request that just finished
+        - float download latency in seconds, None if it failed
+        - boolean True if this counts as an error
+        Returns:
+        - None
+        '''
+
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+
+        state = self.slots.setdefault(key, SlotState())
+        state.error_rate += self.ALPHA * (float(error) - state.error_rate)
+        if latency is not None:
+            state.latency = latency if state.latency is None else \
+                state.latency + self.ALPHA * (latency - state.latency)
+
+        if error or (state.latency or 0) > self.slow_latency:
+            slot.concurrency = max(self.min_concurrency, slot.concurrency // 2)
+            slot.delay = min(self.max_delay, max(slot.delay * 2, self.delay_step))
+            state.good_responses = 0
+            self.stats.inc_value(f'adaptive_throttle/backoff/{key}')
+
+        elif state.latency > self.target_latency:
+            slot.concurrency = max(self.min_concurrency, slot.concurrency - 1)
+            slot.delay = min(self.max_delay, slot.delay + self.delay_step)
+            state.good_responses = 0
+
+        else:
+            state.good_responses += 1
+            if state.good_responses >= slot.concurrency:
+                slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+                slot.delay = max(self.min_delay, slot.delay - self.delay_step)
+                state.good_responses = 0
+
+        self.stats.set_value(f'adaptive_throttle/concurrency/{key}', slot.concurrency)
+        self.stats.set_value(f'adaptive_throttle/delay/{key}', round(slot.delay, 3))
+        if state.latency is not None:
+            self.stats.set_value(f'adaptive_throttle/latency/{key}', round(state.latency, 3))
+        self.stats.set_value(f'adaptive_throttle/error_rate/{key}', round(state.error_rate, 3))
+
+
+class DnsPreflight(object):
+    '''
+    Resolves the start url host of every unit still waiting to be crawled
+    before the spider starts. Lookups go through the crawler's caching
+    resolver, so successful ones warm the DNS cache for the crawl, and
+    hosts that don't resolve are handed to the spider (dead_hosts) so it
+    skips their units instead of spending a slot on DNSLookupError. Dead
+    units get status dns_failed in scrape_ledger; the next run tries
+    them again.
+    '''
+
+    query = '''
+            SELECT id_idcd_plant,
+                    start_url
+            FROM gov_info
+            WHERE start_url IS NOT NULL AND
+            is_scraped=0 AND
+            id_idcd_plant NOT IN (
+                SELECT id_idcd_plant
+                FROM scrape_ledger
+                WHERE status='finished'
+            );
+            '''
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.db_path = crawler.settings.get('DB_PATH', DB)
+        self.concurrency = crawler.settings.getint('DNS_PREFLIGHT_CONCURRENCY', 20)
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('DNS_PREFLIGHT_ENABLED'):
+            raise NotConfigured
+        if not crawler.settings.getbool('DNSCACHE_ENABLED'):
+            logger.warning("DNSCACHE_ENABLED is off; preflight lookups won't be reused by the crawl")
+        return cls(crawler)
+
+    def pending_hosts(self, spider):
+        '''
+        Takes:
+        - spider
+        Returns:
+        - dict of hostname to list of unit IDs waiting to be crawled
+        '''
+
+        dbconn = sqlite3.connect(self.db_path, timeout=30)
+        rows = dbconn.execute(self.query).fetchall()
+        dbconn.close()
+
+        hosts = {}
+        for id_idcd_plant, start_url in rows:
+            parsed = urlparse(start_url)
+            if not parsed.hostname:
+                continue
+            if spider.num_shards > 1 and shard_of(parsed.netloc, spider.num_shards) != spider.shard:
+                continue
+            hosts.setdefault(parsed.hostname, []).append(id_idcd_plant)
+
+        return hosts
+
+    def spider_opened(self, spider):
+        '''
+        Returns a Deferred, which Scrapy waits on before it starts
+        pulling start requests
+        '''
+
+        from twisted.internet import reactor
+
+        hosts = self.pending_hosts(spider)
+        started = time.monotonic()
+        spider.logger.info(f"resolving {len(hosts)} start url hosts before the crawl")
+
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        lookups = [semaphore.run(reactor.resolve, host) for host in hosts]
+
+        dfd = defer.DeferredList(lookups, consumeErrors=True)
+        dfd.addCallback(self.record_results, list(hosts), hosts, started, spider)
+        return dfd
+
+    def record_results(self, results, names, hosts, started, spider):
+        dead = set()
+        for host, (ok, result) in zip(names, results):
+            if ok:
+                continue
+            if result.check(DNSLookupError):
+                dead.add(host)
+            else:
+                spider.logger.debug(f"preflight lookup of {host} failed: {result.getErrorMessage()}")
+
+        spider.dead_hosts.update(dead)
+        for host in dead:
+            for id_idcd_plant in hosts[host]:
+                spider.ledger.mark_unit(id_idcd_plant, 'dns_failed', spider.run_id)
+
+        self.stats.set_value('dns_preflight/resolved', len(names) - len(dead))
+        self.stats.set_value('dns_preflight/failed', len(dead))
+        spider.logger.info(
+            f"resolved {len(names) - len(dead)} of {len(names)} hosts in "
+            f"{time.monotonic() - started:.1f}s; skipping units on {len(dead)} dead hosts"
+        )
+
+
+class DomainStats(object):
+    '''
+    Running counters for one base domain
+    '''
+
+    def __init__(self, id_idcd_plant):
+        self.id_idcd_plant = id_idcd_plant
+        self.requests = 0
+        self.responses = 0
+        self.bytes = 0
+        self.pdfs = 0
+        self.max_depth = 0
+        self.latencies = []
+        self.statuses = Counter()
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+
+    def row(self, run_id, domain):
+        latencies = sorted(self.latencies)
+        mean = sum(latencies) / len(latencies) if latencies else None
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else None
+        return (
+            run_id,
+            domain,
+            self.id_idcd_plant,
+            self.requests,
+            self.responses,
+            self.bytes,
+            mean,
+            p95,
+            json.dumps(dict(sorted(self.statuses.items()))),
+            self.pdfs,
+            self.max_depth,
+            datetime.datetime.fromtimestamp(self.first_seen).isoformat(timespec='seconds'),
+            datetime.datetime.fromtimestamp(self.last_seen).isoformat(timespec='seconds'),
+            round(self.last_seen - self.first_seen, 3),
+        )
+
+
+class DomainTelemetry(object):
+    '''
+    Keeps per base domain counters (requests, responses including cache
+    hits, bytes, mean and p95 download latency of the responses that were
+    downloaded, status codes, pdfs, deepest page and wall time from first
+    request to last response) and writes them to the
+    crawl_telemetry table every TELEMETRY_FLUSH_INTERVAL seconds and when
+    the spider closes, so slow or oversized sites show up mid-crawl.
+    '''
+
+    create = '''
+            CREATE TABLE IF NOT EXISTS "crawl_telemetry" (
+              "run_id" TEXT,
+              "base_domain" TEXT,
+              "id_idcd_plant" TEXT,
+              "num_requests" INTEGER,
+              "num_responses" INTEGER,
+              "bytes" INTEGER,
+              "mean_latency" REAL,
+              "p95_latency" REAL,
+              "status_counts" TEXT,
+              "num_pdfs" INTEGER,
+              "max_depth" INTEGER,
+              "first_seen" TEXT,
+              "last_seen" TEXT,
+              "wall_time" REAL,
+              UNIQUE(run_id, base_domain)
+            );
+            '''
+
+    upsert = '''
+            INSERT INTO crawl_telemetry (
+                run_id,
+                base_domain,
+                id_idcd_plant,
+                num_requests,
+                num_responses,
+                bytes,
+                mean_latency,
+                p95_latency,
+                status_counts,
+                num_pdfs,
+                max_depth,
+                first_seen,
+                last_seen,
+                wall_time
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(run_id, base_domain) DO UPDATE SET
+                id_idcd_plant = COALESCE(crawl_telemetry.id_idcd_plant, excluded.id_idcd_plant),
+                num_requests = excluded.num_requests,
+                num_responses = excluded.num_responses,
+                bytes = excluded.bytes,
+                mean_latency = excluded.mean_latency,
+                p95_latency = excluded.p95_latency,
+                status_counts = excluded.status_counts,
+                num_pdfs = excluded.num_pdfs,
+                max_depth = excluded.max_depth,
+                last_seen = excluded.last_seen,
+                wall_time = excluded.wall_time;
+            '''
+
+    def __init__(self, crawler):
+        self.interval = crawler.settings.getfloat('TELEMETRY_FLUSH_INTERVAL', 60)
+        self.domains = {}
+        self.dirty = set()
+        self.dbconn = sqlite3.connect(crawler.settings.get('DB_PATH', DB), timeout=30)
+        self.dbconn.execute(self.create)
+        self.dbconn.commit()
+        self.flush_task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('TELEMETRY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.flush_task = task.LoopingCall(self.flush, spider)
+        self.flush_task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush(spider)
+        self.dbconn.close()
+
+    def domain_stats(self, request):
+        domain = get_base_domain(request)
+        if domain not in self.domains:
+            self.domains[domain] = DomainStats(request.meta.get('id_idcd_plant'))
+        stats = self.domains[domain]
+        # the first request can be robots.txt, which carries no unit
+        if stats.id_idcd_plant is None:
+            stats.id_idcd_plant = request.meta.get('id_idcd_plant')
+        self.dirty.add(domain)
+        return stats
+
+    def request_reached_downloader(self, request, spider):
+        self.domain_stats(request).requests += 1
+
+    def response_received(self, response, request, spider):
+        stats = self.domain_stats(request)
+        stats.responses += 1
+        stats.last_seen = time.time()
+        stats.bytes += len(response.body)
+        stats.statuses[response.status] += 1
+        stats.max_depth = max(stats.max_depth, request.meta.get('depth', 0))
+
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            stats.latencies.append(latency)
+
+        content_type = str(response.headers.get('content-type', b'')).lower()
+        if "pdf" in content_type:
+            stats.pdfs += 1
+
+    def flush(self, spider):
+        '''
+        Write the domains that changed since the last flush
+        '''
+
+        if not self.dirty:
+            return
+
+        rows = [self.domains[domain].row(spider.run_id, domain) for domain in self.dirty]
+        self.dirty = set()
+
+        try:
+            self.dbconn.executemany(self.upsert, rows)
+            self.dbconn.commit()
+        except sqlite3.Error as e:
+            spider.logger.warning(f"could not write crawl telemetry: {e!r}")
+
+
+class DiskWatermark(object):
+    '''
+    Pauses the crawl while the disk holding FILES_STORE (or HTTPCACHE_DIR,
+    with the cache on) is fuller than DISK_HIGH_WATER (a fraction of its
+    size) and resumes it once usage is back under DISK_LOW_WATER, after
+    StorageReclaimPipeline has cleared out non-SBCs. Requests already in
+    flight still finish. If the disk stays full for DISK_PAUSE_MAX_SECS
+    the spider is closed with reason disk_full, so a crawl with a JOBDIR
+    can be resumed later. Only runs with RECLAIM_ENABLED, since otherwise
+    nothing frees space during the crawl.
+    '''
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.paths = [settings.get('FILES_STORE')]
+        if settings.getbool('HTTPCACHE_ENABLED'):
+            self.paths.append(data_path(settings.get('HTTPCACHE_DIR')))
+        self.high_water = settings.getfloat('DISK_HIGH_WATER')
+        self.low_water = settings.getfloat('DISK_LOW_WATER', self.high_water)
+        self.interval = settings.getfloat('DISK_CHECK_INTERVAL', 30)
+        self.max_pause = settings.getfloat('DISK_PAUSE_MAX_SECS', 0)
+        self.paused_at = None
+        self.check_task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RECLAIM_ENABLED') or \
+            not crawler.settings.getfloat('DISK_HIGH_WATER') or not crawler.settings.get('FILES_STORE'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.check_task = task.LoopingCall(self.check, spider)
+        self.check_task.start(self.interval)
+
+    def spider_closed(self, spider):
+        if self.check_task is not None and self.check_task.running:
+            self.check_task.stop()
+
+    def disk_used(self):
+        '''
+        Returns:
+        - float fraction used of the fullest disk holding a watched path
+        '''
+
+        used = 0.0
+        for path in self.paths:
+            if os.path.exists(path):
+                usage = shutil.disk_usage(path)
+                used = max(used, usage.used / usage.total)
+        return used
+
+    def check(self, spider):
+        used = self.disk_used()
+        engine = self.crawler.engine
+
+        if self.paused_at is None and used >= self.high_water:
+            engine.pause()
+            self.paused_at = time.monotonic()
+            self.stats.inc_value('disk_watermark/pauses')
+            spider.logger.warning(f"disk is {used:.0%} full; pausing the crawl until it is under {self.low_water:.0%}")
+
+        elif self.paused_at is not None and used < self.low_water:
+            engine.unpause()
+            self.stats.inc_value('disk_watermark/paused_secs', round(time.monotonic() - self.paused_at))
+            self.paused_at = None
+            spider.logger.info(f"disk is {used:.0%} full; resuming the crawl")
+
+        elif self.paused_at is not None and self.max_pause and \
+            time.monotonic() - self.paused_at > self.max_pause:
+            spider.logger.error(f"disk still {used:.0%} full after {self.max_pause:.0f}s; closing the spider")
+            self.check_task.stop()
+            if hasattr(engine, 'close_spider_async'):
+                return deferred_from_coro(engine.close_spider_async(reason='disk_full'))
+            return engine.close_spider(spider, 'disk_full')
+
+
+class PageCachePolicy(RFC2616Policy):
+    '''
+    HTTPCACHE_POLICY that follows RFC2616 but never stores pdfs. The files
+    pipeline already keeps every pdf body in FILES_STORE, and the content
+    index hardlinks a pdf that comes back unchanged, so caching them too
+    would store each one twice. Pages are still cached and revalidated.
+    '''
+
+    def should_cache_response(self, response, request):
+        if b'pdf' in response.headers.get('Content-Type', b'').lower():
+            return False
+        return super().should_cache_response(response, request)
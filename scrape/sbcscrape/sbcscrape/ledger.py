@@ -0,0 +1,217 @@
+"""
+Completion ledger for government units crawled by sbc_spider.
+
+Each claimed unit gets a row in the scrape_ledger table. Once every
+request crawled on its behalf has been settled (downloaded and parsed,
+failed, or dropped) it is marked finished, so a restarted crawl can skip
+it without waiting for ingest_scrape_results.py. A unit whose start
+request failed, or that never got a response, is marked failed instead
+and tried again by later runs.
+"""
+
+import datetime
+import sqlite3
+
+from collections import Counter
+
+
+class UnitLedger(object):
+    '''
+    Tracks outstanding requests per id_idcd_plant and records unit
+    status in the scrape_ledger table, which it creates on first use.
+
+    A request counts against its unit from the time the spider hands it
+    to the engine until it is settled. Requests that downloader
+    middlewares re-issue (redirects, retries, range probes) copy their
+    meta and so carry the original's count instead of adding a new one.
+    '''
+
+    create = '''
+            CREATE TABLE IF NOT EXISTS "scrape_ledger" (
+              "id_idcd_plant" TEXT NOT NULL,
+              "run_id" TEXT,
+              "status" TEXT,
+              "started_at" TEXT,
+              "finished_at" TEXT,
+              "num_requests" INTEGER,
+              UNIQUE(id_idcd_plant)
+            );
+            '''
+
+    upsert = '''
+            INSERT INTO scrape_ledger (
+                id_idcd_plant,
+                run_id,
+                status,
+                started_at
+            )
+            VALUES (?, ?, 'started', ?)
+            ON CONFLICT(id_idcd_plant) DO UPDATE SET
+                run_id = excluded.run_id,
+                status = excluded.status,
+                started_at = excluded.started_at,
+                finished_at = NULL;
+            '''
+
+    mark = '''
+            INSERT INTO scrape_ledger (
+                id_idcd_plant,
+                run_id,
+                status
+            )
+            VALUES (?, ?, ?)
+            ON CONFLICT(id_idcd_plant) DO UPDATE SET
+                run_id = excluded.run_id,
+                status = excluded.status;
+            '''
+
+    finish = '''
+            UPDATE scrape_ledger
+            SET status = ?,
+                finished_at = ?,
+                num_requests = ?
+            WHERE id_idcd_plant = ?;
+            '''
+
+    # lets the next run, or another process, retry a failed unit
+    # without waiting for CLAIM_EXPIRY_HOURS
+    release = '''
+            UPDATE gov_info
+            SET scrape_claimed_by = NULL,
+                scrape_claimed_at = NULL
+            WHERE id_idcd_plant = ?;
+            '''
+
+    def __init__(self, db_path, logger):
+        self.dbconn = sqlite3.connect(db_path, timeout=30)
+        self.dbconn.execute(self.create)
+        self.dbconn.commit()
+        self.logger = logger
+        self.outstanding = Counter()
+        self.num_requests = Counter()
+        # units that got at least one response, and units whose start
+        # request failed
+        self.responded = set()
+        self.start_failed = set()
+        self.run_id = None
+
+
+    def start_unit(self, id_idcd_plant):
+        '''
+        Record that a unit has been claimed and its crawl is starting
+        '''
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.dbconn.execute(self.upsert, (id_idcd_plant, self.run_id, now, ))
+        self.dbconn.commit()
+
+
+    def mark_unit(self, id_idcd_plant, status, run_id):
+        '''
+        Record a unit this run won't crawl, e.g. status dns_failed when
+        its host doesn't resolve. Only finished units are skipped by later
+        runs, so these are tried again.
+        '''
+
+        self.dbconn.execute(self.mark, (id_idcd_plant, run_id, status, ))
+        self.dbconn.commit()
+
+
+    def count(self, request):
+        '''
+        Count a new request against its unit
+        '''
+
+        unit = request.meta.get('id_idcd_plant')
+        if unit is None or request.meta.get('ledger_counted'):
+            return
+
+        request.meta['ledger_counted'] = True
+        self.outstanding[unit] += 1
+        self.num_requests[unit] += 1
+
+
+    def request_dropped(self, request, spider):
+        '''
+        Signal handler: the scheduler refused the request (e.g. duplicate)
+        '''
+
+        self.settle(request)
+
+
+    def settle(self, request, responded=False):
+        '''
+        Mark a request as done; finish its unit when nothing is left.
+        Safe to call more than once for the same request.
+
+        Takes:
+        - scrapy Request
+        - boolean True if the request got a response, False if it failed
+          or was dropped
+        Returns:
+        - None
+        '''
+
+        unit = request.meta.get('id_idcd_plant')
+        if unit is None or request.meta.get('ledger_settled'):
+            return
+        request.meta['ledger_settled'] = True
+
+        if responded:
+            self.responded.add(unit)
+        elif request.meta.get('ledger_start'):
+            self.start_failed.add(unit)
+
+        # requests restored from a job directory were counted by an
+        # earlier process; those units finish when the crawl does
+        if self.outstanding[unit] <= 0:
+            return
+
+        self.outstanding[unit] -= 1
+        if self.outstanding[unit] == 0:
+            self.finish_unit(unit)
+
+
+    def finish_unit(self, unit):
+        '''
+        Write the final status for a unit: finished, or failed if its
+        start request failed or nothing was downloaded for it. A failed
+        unit's claim is released.
+        '''
+
+        if unit in self.responded and unit not in self.start_failed:
+            status = 'finished'
+        else:
+            status = 'failed'
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.dbconn.execute(self.finish, (status, now, self.num_requests[unit], unit, ))
+        if status == 'failed':
+            self.dbconn.execute(self.release, (unit, ))
+        self.dbconn.commit()
+        del self.outstanding[unit]
+        self.responded.discard(unit)
+        self.start_failed.discard(unit)
+        self.logger.info(f"unit {unit} {status} after {self.num_requests[unit]} requests")
+
+
+    def close(self, reason):
+        '''
+        On a clean finish the whole frontier is done, so any unit this run
+        started (including ones resumed from a job directory) is finished.
+        Otherwise leave them as started so the next run picks them up.
+        '''
+
+        if reason == 'finished' and self.run_id is not None:
+            now = datetime.datetime.now().isoformat(timespec='seconds')
+            self.dbconn.execute(
+                '''
+                UPDATE scrape_ledger
+                SET status = 'finished', finished_at = ?
+                WHERE run_id = ? AND status = 'started';
+                ''',
+                (now, self.run_id, ),
+            )
+            self.dbconn.commit()
+
+        self.dbconn.close()
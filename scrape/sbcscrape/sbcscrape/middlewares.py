@@ -5,7 +5,18 @@
 
 import datetime
 import os
-from scrapy import signals
+import re
+import sqlite3
+from collections import Counter, defaultdict
+from urllib.parse import parse_qsl, urlparse
+
+from scrapy import Request, signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from sbcscrape.classify import is_pdf_chunk_sbc
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -31,6 +42,411 @@ class SaveErrorsMiddleware(object):
         self.output_file.write(response.url + '\n')
 
 
+def get_base_domain(request):
+    '''
+    Base domain a request is crawled under: the start url domain the
+    spider stamped in meta, falling back to the request's own host
+    '''
+
+    return request.meta.get('base_domain') or urlparse(request.url).netloc
+
+
+class DomainBudgetMiddleware(object):
+    '''
+    Downloader middleware that caps how much of the crawl a single base
+    domain can use. Once a domain spends its page, pdf or byte budget, or
+    yields DOMAIN_BUDGET_SBCS confirmed SBCs, further requests for it are
+    ignored so small sites aren't stuck behind it in the queue. A budget
+    of 0 means unlimited. Counting SBCs needs SBC_CHECK_ENABLED.
+    '''
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.max_pages = settings.getint('DOMAIN_BUDGET_PAGES')
+        self.max_pdfs = settings.getint('DOMAIN_BUDGET_PDFS')
+        self.max_bytes = settings.getint('DOMAIN_BUDGET_BYTES')
+        self.max_sbcs = settings.getint('DOMAIN_BUDGET_SBCS')
+
+        self.pages = defaultdict(int)
+        self.pdfs = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.sbcs = defaultdict(int)
+        self.exhausted = {}
+
+        crawler.signals.connect(self.item_scraped, signals.item_scraped)
+        crawler.signals.connect(self.spider_opened, signals.spider_opened)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        if self.max_sbcs and not spider.settings.getbool('SBC_CHECK_ENABLED'):
+            spider.logger.warning("DOMAIN_BUDGET_SBCS is set but SBC_CHECK_ENABLED is off; SBCs won't be counted")
+
+    def process_request(self, request, spider):
+        domain = get_base_domain(request)
+        if domain in self.exhausted:
+            self.stats.inc_value('domain_budget/ignored_requests')
+            raise IgnoreRequest(f"{domain} is over its {self.exhausted[domain]} budget")
+        return None
+
+    def process_response(self, request, response, spider):
+        domain = get_base_domain(request)
+        content_type = str(response.headers.get('content-type', b'')).lower()
+
+        if "pdf" in content_type:
+            self.pdfs[domain] += 1
+        else:
+            self.pages[domain] += 1
+        self.bytes[domain] += len(response.body)
+
+        if self.max_pages and self.pages[domain] >= self.max_pages:
+            self.close_domain(domain, 'page', spider)
+        elif self.max_pdfs and self.pdfs[domain] >= self.max_pdfs:
+            self.close_domain(domain, 'pdf', spider)
+        elif self.max_bytes and self.bytes[domain] >= self.max_bytes:
+            self.close_domain(domain, 'byte', spider)
+
+        return response
+
+    def item_scraped(self, item, response, spider):
+        if not self.max_sbcs or not item.get('is_sbc'):
+            return
+
+        domain = get_base_domain(response.request)
+        self.sbcs[domain] += 1
+        if self.sbcs[domain] >= self.max_sbcs:
+            self.close_domain(domain, 'SBC', spider)
+
+    def close_domain(self, domain, budget, spider):
+        if domain in self.exhausted:
+            return
+        self.exhausted[domain] = budget
+        self.stats.inc_value(f'domain_budget/exhausted/{budget}')
+        spider.logger.info(f"{domain} reached its {budget} budget; skipping the rest of it")
+
+
+class PdfRangeProbeMiddleware(object):
+    '''
+    Downloader middleware that fetches only the first chunk of a candidate
+    pdf with an HTTP Range header and runs the SBC title check on it.
+    SBC hits, and chunks we can't read, are requested again in full;
+    everything else comes back as the partial response with
+    meta['pdf_probe'] = 'not_sbc' so the spider records it but doesn't
+    save the file. The probe only decides what to download: fetched files
+    get the full SBC check like any other. Servers that ignore Range just
+    send the whole file. Chunks are checked in a pool of
+    PDF_RANGE_PROBE_THREADS threads, apart from the reactor's pool.
+    Enabled with the PDF_RANGE_PROBE_ENABLED setting.
+    '''
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.probe_bytes = settings.getint('PDF_RANGE_PROBE_BYTES')
+        self.sbc_title = settings.get('SBC_TITLE_TEXT')
+        self.threadpool = ThreadPool(
+            minthreads=1,
+            maxthreads=settings.getint('PDF_RANGE_PROBE_THREADS', 2),
+            name='pdf-range-probe',
+        )
+
+        crawler.signals.connect(self.spider_opened, signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PDF_RANGE_PROBE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.threadpool.start()
+
+    def spider_closed(self, spider):
+        return deferToThread(self.threadpool.stop)
+
+    def process_request(self, request, spider):
+        if 'pdf_probe' in request.meta or b'Range' in request.headers:
+            return None
+        if not urlparse(request.url).path.lower().endswith('.pdf'):
+            return None
+
+        # the cache key ignores headers, so a partial response must never
+        # be stored where the full file would be looked up
+        request.headers['Range'] = f'bytes=0-{self.probe_bytes - 1}'
+        request.meta['pdf_probe'] = 'range'
+        request.meta['dont_cache'] = True
+        self.stats.inc_value('pdf_probe/range_requests')
+        return None
+
+    def process_response(self, request, response, spider):
+        if request.meta.get('pdf_probe') != 'range':
+            return response
+
+        # server ignored the Range header and sent the whole file
+        if response.status == 200:
+            request.meta['pdf_probe'] = 'full'
+            self.stats.inc_value('pdf_probe/range_ignored')
+            return response
+
+        content_type = str(response.headers.get('content-type', b'')).lower()
+        if response.status != 206 or "pdf" not in content_type:
+            return self.full_request(request, 'unchecked')
+
+        dfd = deferToThreadPool(reactor, self.threadpool, self.check_chunk, response.body)
+        dfd.addCallback(self.handle_verdict, request, response)
+        return dfd
+
+    def check_chunk(self, body):
+        '''
+        Returns:
+        - True/False verdict on the chunk, None if it couldn't be parsed
+        '''
+
+        try:
+            return is_pdf_chunk_sbc(body, self.sbc_title)
+        except Exception:
+            return None
+
+    def handle_verdict(self, verdict, request, response):
+        if verdict is None:
+            self.stats.inc_value('pdf_probe/inconclusive')
+            return self.full_request(request, 'unchecked')
+
+        if verdict:
+            self.stats.inc_value('pdf_probe/sbc')
+            return self.full_request(request, 'sbc')
+
+        self.stats.inc_value('pdf_probe/not_sbc')
+        request.meta['pdf_probe'] = 'not_sbc'
+        return response
+
+    def full_request(self, request, probe_result):
+        '''
+        Same request without the Range header, tagged with what the
+        probe found
+        '''
+
+        full = request.replace(dont_filter=True)
+        del full.headers['Range']
+        full.meta['pdf_probe'] = probe_result
+        full.meta.pop('dont_cache', None)
+        return full
+
+
+class UnitLedgerMiddleware(object):
+    '''
+    Spider middleware that counts each request the callback produced
+    against its unit in the spider's ledger, then settles the response's
+    own request once the output is exhausted. It should sit close to the
+    engine so requests dropped by e.g. DepthMiddleware are never counted.
+    Errors raised before the callback ran (e.g. HttpError) have already
+    been settled as failures by the spider's errback.
+    '''
+
+    def process_spider_output(self, response, result, spider):
+        for i in result:
+            if isinstance(i, Request):
+                spider.ledger.count(i)
+            yield i
+        spider.ledger.settle(response.request, responded=True)
+
+    async def process_spider_output_async(self, response, result, spider):
+        # newer Scrapy versions may hand us asynchronous output
+        async for i in result:
+            if isinstance(i, Request):
+                spider.ledger.count(i)
+            yield i
+        spider.ledger.settle(response.request, responded=True)
+
+    def process_spider_exception(self, response, exception, spider):
+        spider.ledger.settle(response.request, responded=True)
+        return None
+
+
+# digit runs (page numbers, dates, ids) and long hex/uuid tokens in urls
+DIGITS = re.compile(r'\d+')
+HEX_TOKEN = re.compile(r'^[0-9a-f-]{16,}$')
+# links to pdfs and to the handlers that serve documents by id (e.g.
+# ShowDocument.ashx?id=12, /DocumentCenter/View/34, /download/56); a site
+# can have thousands of these under one template
+DEFAULT_DOCUMENT_PATTERNS = [r'\.pdf$', r'document', r'download', r'getfile', r'viewfile', r'attachment']
+
+
+def url_template(url):
+    '''
+    Collapse a url into a path/query template, so pages that only differ
+    by a number, date or id (calendar days, pagination, search facets)
+    share one template. Query values are dropped and keys are sorted.
+
+    Takes:
+    - string url
+    Returns:
+    - string template, e.g. /calendar/{n}/{n}?month&view
+    '''
+
+    parsed = urlparse(url)
+
+    segments = []
+    for segment in parsed.path.lower().split('/'):
+        if HEX_TOKEN.match(segment):
+            segments.append('{id}')
+        else:
+            segments.append(DIGITS.sub('{n}', segment))
+
+    keys = sorted(set(key.lower() for key, _ in parse_qsl(parsed.query, keep_blank_values=True)))
+
+    template = '/'.join(segments) or '/'
+    if keys:
+        template += '?' + '&'.join(keys)
+    return template
+
+
+class CrawlTrapMiddleware(object):
+    '''
+    Spider middleware that drops followed links once their domain has
+    requested TRAP_TEMPLATE_CAP urls with the same template (see
+    url_template), and links whose path repeats a segment more than
+    TRAP_MAX_SEGMENT_REPEATS times (/a/b/a/b/a/b). Dropping them before
+    they reach the scheduler keeps calendars, faceted search and
+    endless pagination from using up the crawl's concurrency. Links whose
+    path matches TRAP_DOCUMENT_PATTERNS (pdfs and document handlers) are
+    not held to the template cap, so sites with many documents keep them.
+
+    Each tripped template is logged once to the crawl_traps table, with
+    the number of links dropped for it written when the spider closes.
+    It should sit above UnitLedgerMiddleware so dropped links are never
+    counted against their unit.
+    '''
+
+    create = '''
+            CREATE TABLE IF NOT EXISTS "crawl_traps" (
+              "run_id" TEXT,
+              "base_domain" TEXT,
+              "template" TEXT,
+              "reason" TEXT,
+              "example_url" TEXT,
+              "tripped_at" TEXT,
+              "num_dropped" INTEGER
+            );
+            '''
+
+    insert = '''
+            INSERT INTO crawl_traps (
+                run_id,
+                base_domain,
+                template,
+                reason,
+                example_url,
+                tripped_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?);
+            '''
+
+    update = '''
+            UPDATE crawl_traps
+            SET num_dropped = ?
+            WHERE run_id = ? AND base_domain = ? AND template = ?;
+            '''
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.template_cap = settings.getint('TRAP_TEMPLATE_CAP')
+        self.max_repeats = settings.getint('TRAP_MAX_SEGMENT_REPEATS')
+        if not self.template_cap and not self.max_repeats:
+            raise NotConfigured
+        self.document_patterns = [
+            re.compile(pattern)
+            for pattern in settings.getlist('TRAP_DOCUMENT_PATTERNS') or DEFAULT_DOCUMENT_PATTERNS
+        ]
+
+        self.dbconn = sqlite3.connect(settings.get('DB_PATH'), timeout=30)
+        self.dbconn.execute(self.create)
+        self.dbconn.commit()
+        self.seen = defaultdict(set)
+        self.dropped = Counter()
+
+        crawler.signals.connect(self.spider_closed, signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_closed(self, spider):
+        self.dbconn.executemany(self.update, [
+            (num_dropped, spider.run_id, domain, template, )
+            for (domain, template), num_dropped in self.dropped.items()
+        ])
+        self.dbconn.commit()
+        self.dbconn.close()
+
+    def is_document(self, url):
+        path = urlparse(url).path.lower()
+        return any(pattern.search(path) for pattern in self.document_patterns)
+
+    def is_trap(self, request, spider):
+        '''
+        Takes:
+        - request the spider produced
+        Returns:
+        - boolean True if the request should be dropped
+        '''
+
+        domain = get_base_domain(request)
+        template = url_template(request.url)
+        key = (domain, template)
+
+        if key in self.dropped:
+            self.dropped[key] += 1
+            return True
+
+        reason = None
+        if self.max_repeats:
+            segments = Counter(s for s in template.split('?')[0].split('/') if s)
+            if segments and max(segments.values()) > self.max_repeats:
+                reason = 'repeated_segment'
+
+        # count distinct urls; repeats are left to the dupefilter
+        if reason is None and self.template_cap and request.url not in self.seen[key] \
+                and not self.is_document(request.url):
+            if len(self.seen[key]) >= self.template_cap:
+                reason = 'template_cap'
+            else:
+                self.seen[key].add(request.url)
+
+        if reason is None:
+            return False
+
+        self.dropped[key] += 1
+        self.stats.inc_value(f'crawl_trap/tripped/{reason}')
+        spider.logger.info(f"crawl trap on {domain}: dropping links like {template} ({reason})")
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.dbconn.execute(self.insert, (spider.run_id, domain, template, reason, request.url, now, ))
+        self.dbconn.commit()
+        return True
+
+    def filter_result(self, i, spider):
+        if isinstance(i, Request) and self.is_trap(i, spider):
+            self.stats.inc_value('crawl_trap/dropped')
+            return False
+        return True
+
+    def process_spider_output(self, response, result, spider):
+        for i in result:
+            if self.filter_result(i, spider):
+                yield i
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for i in result:
+            if self.filter_result(i, spider):
+                yield i
+
+
 class SbcscrapeSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the spider middleware does not modify the
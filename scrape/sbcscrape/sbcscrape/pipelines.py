@@ -4,8 +4,34 @@ Define pipelines for how scraped items are processed
 
 import csv
 import datetime
+import gzip
+import hashlib
 import logging
-import pandas as pd
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from io import BytesIO
+
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.pipelines.files import FilesPipeline, FSFilesStore
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import reactor, task
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from sbcscrape.classify import is_pdf_sbc
+from sbcscrape.content_index import ContentIndex
+
+# optional; only needed for ParquetPipeline
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # instantiate logger
 logger = logging.getLogger(__name__)
@@ -15,69 +41,790 @@ logger = logging.getLogger(__name__)
 SCRAPED_DATA_PATH = "/data/data/webscraping/scraped_data/"
 PDF_METADATA_NAME = "_pdfs_from_sbc_spider.csv"
 SCRAPE_METADATA_NAME = "_scrape_run_metadata.csv"
+SCRAPE_PARQUET_NAME = "_scrape_run_metadata.parquet"
+
+# column order of the metadata csvs, which have no header row
+SCRAPE_COLUMNS = ['referring_url', 'url', 'base_domain', 'file_type', 'id_idcd_plant', 'start_url']
+FILES_COLUMNS = ['url', 'path', 'checksum', 'status']
+PDF_ITEM_COLUMNS = ['base_domain', 'id_idcd_plant', 'start_url']
 
 # globals for dev
 # PDF_METADATA = "/data/data/webscraping/scraped_data/dev_pdfs.csv"
 # SCRAPE_METADATA = "/data/data/webscraping/scraped_data/dev_scrape.csv"
 
 
+class PrefetchedFilesPipeline(FilesPipeline):
+    '''
+    FilesPipeline that saves the pdf body the spider already downloaded
+    instead of requesting the same url a second time. The spider passes
+    the crawl response along in the item's file_response field; any
+    url without a matching response falls back to a normal download.
+    The files field keeps the usual url, path, checksum and status keys.
+
+    With CONTENT_INDEX_ENABLED, every stored file is looked up by checksum
+    in the shared ContentIndex. Content already stored under another url
+    or in an earlier year is hardlinked to the existing copy, and the
+    item inherits that copy's SBC verdict.
+    '''
+
+    content_index = None
+
+    def get_media_requests(self, item, info):
+        '''
+        Build one request per file url, attaching the spider's response
+        when it belongs to that url
+        '''
+
+        response = item.get('file_response')
+
+        requests = []
+        for url in item.get(self.files_urls_field, []):
+            request = Request(url)
+            if response is not None and response.url == url:
+                request.meta['prefetched_response'] = response
+            requests.append(request)
+
+        return requests
+
+
+    def media_to_download(self, request, info, *, item=None):
+        '''
+        Persist the prefetched body directly; otherwise run the normal
+        up-to-date check and download
+        '''
+
+        response = request.meta.pop('prefetched_response', None)
+        if response is None:
+            return super().media_to_download(request, info, item=item)
+
+        return self.media_downloaded(response, request, info, item=item)
+
+
+    def get_content_index(self, info):
+        '''
+        Open the content index on first use; only local file stores can
+        be hardlinked
+        '''
+
+        settings = info.spider.settings
+        if self.content_index is None and settings.getbool('CONTENT_INDEX_ENABLED') \
+            and isinstance(self.store, FSFilesStore):
+            self.content_index = ContentIndex(settings.get('CONTENT_INDEX_DB'))
+        return self.content_index
+
+
+    def file_downloaded(self, response, request, info, *, item=None):
+        '''
+        Hardlink content we already have instead of writing it again
+        '''
+
+        index = self.get_content_index(info)
+        if index is None:
+            return super().file_downloaded(response, request, info, item=item)
+
+        path = self.file_path(request, response=response, info=info, item=item)
+        full_path = os.path.join(self.store.basedir, path)
+        checksum = hashlib.md5(response.body).hexdigest()
+
+        known = index.lookup(checksum)
+        if known is not None and self.link_file(known[0], full_path):
+            info.spider.crawler.stats.inc_value('content_index/linked')
+            return checksum
+
+        self.store.persist_file(path, BytesIO(response.body), info)
+        # new content, or the old copy is gone and this one replaces it
+        index.add(checksum, full_path, request.url)
+        return checksum
+
+
+    def link_file(self, source, dest):
+        '''
+        Takes:
+        - string path of the stored copy
+        - string path this download would be stored at
+        Returns:
+        - boolean True if dest now points at the stored copy
+        '''
+
+        if not os.path.exists(source):
+            return False
+        if os.path.exists(dest) and os.path.samefile(source, dest):
+            return True
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = dest + '.link'
+        try:
+            os.link(source, tmp)
+            os.replace(tmp, dest)
+        except OSError as e:
+            # e.g. the stored copy is on another filesystem
+            logger.debug(f"could not link {source} to {dest}: {e!r}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+
+    def item_completed(self, results, item, info):
+        '''
+        Drop the response from the item once the file is stored so the
+        body isn't held by later pipelines. With the content index on,
+        take a known SBC verdict for the item's files from the index.
+        '''
+
+        item.pop('file_response', None)
+        item = super().item_completed(results, item, info)
+
+        checksums = set(f['checksum'] for f in item.get('files') or [])
+        if self.content_index is None or not checksums:
+            return item
+
+        verdicts = self.content_index.verdicts(checksums)
+        if any(verdicts.values()):
+            item['is_sbc'] = True
+        elif verdicts and len(verdicts) == len(checksums):
+            item['is_sbc'] = False
+
+        if item.get('is_sbc') is not None:
+            info.spider.crawler.stats.inc_value('content_index/inherited_verdict')
+        return item
+
+
+class SbcCheckPipeline(object):
+    '''
+    Pipeline class that runs the SBC title check on pdfs as soon as the
+    files pipeline has stored them. Sets is_sbc on the item so other
+    components (e.g. DomainBudgetMiddleware) can act on confirmed SBCs,
+    and sbc_checked so SqliteResultsPipeline knows the verdict is its own.
+    Checks run in their own pool of SBC_CHECK_THREADS threads, so a run of
+    slow pdfs can't starve the reactor's pool, which DNS lookups use.
+    Enabled with the SBC_CHECK_ENABLED setting.
+    '''
+
+    def __init__(self, files_store, sbc_title, content_index=None, threads=2):
+        self.files_store = files_store
+        self.sbc_title = sbc_title
+        self.content_index = content_index
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=threads, name='sbc-check')
+
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SBC_CHECK_ENABLED'):
+            raise NotConfigured
+        content_index = None
+        if crawler.settings.getbool('CONTENT_INDEX_ENABLED'):
+            content_index = ContentIndex(crawler.settings.get('CONTENT_INDEX_DB'))
+        return cls(
+            crawler.settings.get('FILES_STORE'),
+            crawler.settings.get('SBC_TITLE_TEXT'),
+            content_index,
+            crawler.settings.getint('SBC_CHECK_THREADS', 2),
+        )
+
+
+    def open_spider(self, spider):
+        self.threadpool.start()
+
+
+    def close_spider(self, spider):
+        return deferToThread(self.threadpool.stop)
+
+
+    def process_item(self, item, spider):
+        '''
+        Check stored pdfs in a thread so pdfminer doesn't block the crawl
+        '''
+
+        # nothing stored, or the content index already had a verdict
+        if not item.get('files') or item.get('is_sbc') is not None:
+            return item
+
+        paths = [os.path.join(self.files_store, f['path']) for f in item['files']]
+
+        dfd = deferToThreadPool(reactor, self.threadpool, self.check_files, paths)
+        dfd.addCallback(self.set_verdict, item, spider)
+        return dfd
+
+
+    def check_files(self, paths):
+        '''
+        Takes:
+        - list of filepaths to stored pdfs
+        Returns:
+        - boolean True if any of them is an SBC, None if none could be read
+        '''
+
+        verdict = None
+        for path in paths:
+            try:
+                if is_pdf_sbc(path, self.sbc_title):
+                    return True
+                verdict = False
+            except Exception as e:
+                logger.debug(f"could not check {path} for SBC title: {e!r}")
+
+        return verdict
+
+
+    def set_verdict(self, verdict, item, spider):
+        item['is_sbc'] = verdict
+        item['sbc_checked'] = verdict is not None
+        if self.content_index is not None and verdict is not None:
+            self.content_index.set_verdict([f['checksum'] for f in item['files']], verdict)
+        if verdict:
+            spider.crawler.stats.inc_value('sbc_check/sbc_count')
+        return item
+
+
+class StorageReclaimPipeline(object):
+    '''
+    Pipeline class that frees disk space as soon as a stored pdf is known
+    not to be an SBC (from SbcCheckPipeline or the content index), so the file store grows with the SBCs rather than
+    with every pdf crawled. RECLAIM_ACTION 'delete' removes the file and
+    'gzip' replaces it with a compressed copy. The item's files entries
+    are updated (status, and path for gzip) so the metadata shows what
+    happened. Files are reclaimed in a pool of RECLAIM_THREADS threads,
+    so gzipping a large pdf doesn't hold a thread DNS lookups need.
+    Enabled with RECLAIM_ENABLED; needs SBC_CHECK_ENABLED.
+    '''
+
+    def __init__(self, files_store, action, stats, threads=1):
+        self.files_store = files_store
+        self.action = action
+        self.stats = stats
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=threads, name='storage-reclaim')
+
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RECLAIM_ENABLED'):
+            raise NotConfigured
+        if not crawler.settings.getbool('SBC_CHECK_ENABLED'):
+            logger.warning("RECLAIM_ENABLED is set but SBC_CHECK_ENABLED is off; only pdfs with a known verdict are reclaimed")
+        action = crawler.settings.get('RECLAIM_ACTION', 'delete')
+        if action not in ('delete', 'gzip'):
+            raise ValueError(f"RECLAIM_ACTION must be 'delete' or 'gzip', not {action!r}")
+        return cls(
+            crawler.settings.get('FILES_STORE'),
+            action,
+            crawler.stats,
+            crawler.settings.getint('RECLAIM_THREADS', 1),
+        )
+
+
+    def open_spider(self, spider):
+        self.threadpool.start()
+
+
+    def close_spider(self, spider):
+        return deferToThread(self.threadpool.stop)
+
+
+    def process_item(self, item, spider):
+        if item.get('is_sbc') is not False or not item.get('files'):
+            return item
+
+        dfd = deferToThreadPool(reactor, self.threadpool, self.reclaim_files, item['files'])
+        dfd.addCallback(lambda _: item)
+        return dfd
+
+
+    def reclaim_files(self, files):
+        '''
+        Takes:
+        - list of files dicts from FilesPipeline, updated in place
+        Returns:
+        - None
+        '''
+
+        for f in files:
+            path = os.path.join(self.files_store, f['path'])
+            try:
+                size = os.path.getsize(path)
+                if self.action == 'gzip':
+                    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dest:
+                        shutil.copyfileobj(src, dest)
+                    f['path'] += '.gz'
+                    size -= os.path.getsize(path + '.gz')
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"could not reclaim {path}: {e!r}")
+                continue
+
+            f['status'] = 'deleted' if self.action == 'delete' else 'gzipped'
+            self.stats.inc_value(f'reclaim/{f["status"]}')
+            self.stats.inc_value('reclaim/bytes', size)
+
+
+class BufferedCsvWriter(object):
+    '''
+    Appends rows to a csv through one open file handle, holding them in a
+    list until flush() so the crawl doesn't pay for a write per item. The
+    file is only created once there is something to write.
+    '''
+
+    def __init__(self, path, batch_size):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.file = None
+        self.writer = None
+
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+        self.writer.writerows(self.rows)
+        self.file.flush()
+        self.rows = []
+
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 class SbcscrapePipeline(object):
     '''
-    Pipeline class for metadata (urls, domains, filetypes) from sbc_spider
+    Pipeline class for metadata (urls, domains, filetypes) from sbc_spider.
+    Rows are buffered and appended to the two metadata csvs every
+    METADATA_BATCH_SIZE rows, every METADATA_FLUSH_INTERVAL seconds and
+    when the spider closes.
     '''
 
     run_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M")
 
+    def __init__(self, scraped_data_path=SCRAPED_DATA_PATH, batch_size=500, flush_interval=30):
+        self.scraped_data_path = scraped_data_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_task = None
+
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # sharded crawls give each process its own output directory
+        return cls(
+            crawler.settings.get('SCRAPED_DATA_PATH', SCRAPED_DATA_PATH),
+            crawler.settings.getint('METADATA_BATCH_SIZE', 500),
+            crawler.settings.getfloat('METADATA_FLUSH_INTERVAL', 30),
+        )
+
+
+    def open_spider(self, spider):
+        self.scrape_writer = BufferedCsvWriter(
+            os.path.join(self.scraped_data_path, self.run_timestamp + SCRAPE_METADATA_NAME),
+            self.batch_size,
+        )
+        self.pdf_writer = BufferedCsvWriter(
+            os.path.join(self.scraped_data_path, self.run_timestamp + PDF_METADATA_NAME),
+            self.batch_size,
+        )
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.flush_interval, now=False)
+
+
+    def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.scrape_writer.close()
+        self.pdf_writer.close()
+
+
+    def flush(self):
+        self.scrape_writer.flush()
+        self.pdf_writer.flush()
+
+
     def process_item(self, item, spider):
         '''
         Method that processes/saves items coming in from spider
         '''
 
-        # convert data from spider into dataframe
-        item_df = pd.DataFrame.from_dict({
-            'referring_url': [item['referring_url'],],
-            'url': [item['url'],],
-            'base_domain': [item['base_domain'],],
-            'file_type': [item['file_type'],],
-        })
+        self.scrape_writer.write([item.get(col) for col in SCRAPE_COLUMNS])
 
         # if pdf(s) are found, this item component is a list of dicts
-        if item['files']:
-            files_dict_list = item['files']
+        for files_dict in item.get('files') or []:
+            self.pdf_writer.write(
+                [files_dict.get(col) for col in FILES_COLUMNS] + \
+                [item.get(col) for col in PDF_ITEM_COLUMNS]
+            )
+
+        return item
+
+
+class SqliteResultsPipeline(object):
+    '''
+    Pipeline class that streams crawl results into the latest_scrape and
+    scraped_pdfs tables, so ingest_scrape_results.py isn't needed. Items
+    are handed to a writer thread through a queue and inserted with
+    executemany every SQLITE_BATCH_SIZE rows or SQLITE_FLUSH_INTERVAL
+    seconds. Verdicts reached during the crawl go to sbc_check, so
+    identify_sbc.py skips those pdfs. When the spider closes, pdf_count,
+    is_scraped and num_scraped in gov_info are updated for the units the
+    ledger lists as finished. A batch that hits a locked database is
+    retried with backoff; any other DB error closes the spider with
+    reason sqlite_error. Enabled with SQLITE_RESULTS_ENABLED.
+    '''
+
+    insert_page = '''
+            INSERT INTO latest_scrape (
+                referring_url,
+                url,
+                base_domain,
+                file_type,
+                id_idcd_plant,
+                run_id
+            )
+            VALUES (?, ?, ?, ?, ?, ?);
+            '''
+
+    insert_pdf = '''
+            INSERT INTO scraped_pdfs (
+                url,
+                relative_filepath,
+                file_hash,
+                download_or_uptodate,
+                base_domain,
+                path_to_pdf,
+                id_idcd_plant,
+                start_url
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            '''
+
+    insert_check = '''
+            INSERT OR IGNORE INTO sbc_check (
+                id_idcd_plant,
+                path_to_pdf,
+                is_pdf_sbc
+            )
+            VALUES (?, ?, ?);
+            '''
+
+    update_pdf_count = '''
+            WITH pdf_count AS (
+                SELECT id_idcd_plant, COUNT(DISTINCT file_hash) AS pdf_count
+                FROM scraped_pdfs
+                GROUP BY id_idcd_plant
+            )
+            UPDATE gov_info
+            SET pdf_count = (
+                SELECT pdf_count FROM pdf_count
+                WHERE pdf_count.id_idcd_plant = gov_info.id_idcd_plant
+            )
+            WHERE id_idcd_plant IN (SELECT id_idcd_plant FROM pdf_count);
+            '''
+
+    update_scraped = '''
+            WITH scrape_summary AS (
+                SELECT id_idcd_plant,
+                    COUNT(url) AS num_scraped
+                FROM latest_scrape
+                WHERE id_idcd_plant IN (
+                    SELECT id_idcd_plant
+                    FROM scrape_ledger
+                    WHERE status='finished'
+                )
+                GROUP BY id_idcd_plant
+            )
+            UPDATE gov_info
+            SET is_scraped = 1,
+                num_scraped = (
+                    SELECT num_scraped FROM scrape_summary
+                    WHERE scrape_summary.id_idcd_plant = gov_info.id_idcd_plant
+                )
+            WHERE id_idcd_plant IN (SELECT id_idcd_plant FROM scrape_summary);
+            '''
+
+    def __init__(self, crawler, db_path, files_store, batch_size=500, flush_interval=5, write_retries=5):
+        self.crawler = crawler
+        self.db_path = db_path
+        self.files_store = files_store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_retries = write_retries
+        self.queue = queue.Queue()
+        self.writer = None
+        self.error = None
+
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SQLITE_RESULTS_ENABLED'):
+            raise NotConfigured
+        pipeline = cls(
+            crawler,
+            crawler.settings.get('DB_PATH'),
+            # sharded crawls store pdfs elsewhere until they are merged
+            crawler.settings.get('SQLITE_PDF_ROOT') or crawler.settings.get('FILES_STORE'),
+            crawler.settings.getint('SQLITE_BATCH_SIZE', 500),
+            crawler.settings.getfloat('SQLITE_FLUSH_INTERVAL', 5),
+            crawler.settings.getint('SQLITE_WRITE_RETRIES', 5),
+        )
+        # runs after the spider's handler, which closes out the ledger
+        crawler.signals.connect(pipeline.spider_closed, signals.spider_closed)
+        return pipeline
+
+
+    def open_spider(self, spider):
+        self.ensure_columns()
+        self.writer = threading.Thread(target=self.write_rows, name='sqlite-results', daemon=True)
+        self.writer.start()
+
+
+    def ensure_columns(self):
+        '''
+        Add run_id to latest_scrape in databases made before it was in
+        the schema
+        '''
+
+        dbconn = sqlite3.connect(self.db_path, timeout=30)
+        columns = [row[1] for row in dbconn.execute("PRAGMA table_info('latest_scrape');")]
+        if columns and 'run_id' not in columns:
+            logger.info("adding run_id to latest_scrape")
+            with dbconn:
+                dbconn.execute('ALTER TABLE latest_scrape ADD COLUMN run_id TEXT;')
+        dbconn.close()
+
+
+    def close_spider(self, spider):
+        '''
+        Tell the writer to finish and wait for it without blocking the reactor
+        '''
 
-            for files_dict in files_dict_list:
-                files_dict['base_domain'] = item['base_domain']
+        self.queue.put(None)
+        dfd = deferToThread(self.writer.join)
+        dfd.addCallback(self.raise_error)
+        return dfd
 
-            file_metadata = pd.DataFrame.from_dict(files_dict_list)
-            pdf_csv_name = SCRAPED_DATA_PATH + self.run_timestamp + PDF_METADATA_NAME
-            self.save_scrape_metadata(file_metadata, pdf_csv_name)
 
+    def raise_error(self, _):
+        if self.error is not None:
+            raise self.error
 
-        # use category as filename?
-        csv_name = SCRAPED_DATA_PATH + self.run_timestamp + SCRAPE_METADATA_NAME
-        
-        # write to CSV
-        self.save_scrape_metadata(item_df, csv_name)
 
+    def spider_closed(self, spider, reason):
+        # counts from a partial write would mark units scraped
+        if self.error is not None:
+            return
+        return deferToThread(self.update_gov_info, spider)
+
+
+    def process_item(self, item, spider):
+        '''
+        Turn the item into table rows and queue them for the writer
+        '''
+
+        if item.get('id_idcd_plant') is None:
+            spider.logger.warning(f"no unit ID for {item.get('url')}; not writing it to the DB")
+            return item
+        # the writer has stopped and the spider is closing
+        if self.error is not None:
+            return item
+
+        page = (
+            as_text(item.get('referring_url')),
+            item.get('url'),
+            item.get('base_domain'),
+            as_text(item.get('file_type')),
+            item.get('id_idcd_plant'),
+            # restored from the job state on a resumed crawl, after open_spider
+            spider.run_id,
+        )
+        pdfs = [
+            (
+                f.get('url'),
+                f.get('path'),
+                f.get('checksum'),
+                f.get('status'),
+                item.get('base_domain'),
+                os.path.join(self.files_store, f.get('path')),
+                item.get('id_idcd_plant'),
+                item.get('start_url'),
+            )
+            for f in item.get('files') or []
+        ]
+
+        # only verdicts from the full check, or for files reclaimed on a
+        # verdict, go to sbc_check; identify_sbc.py checks everything else
+        checks = [
+            (pdf[6], pdf[5], int(item['is_sbc']))
+            for pdf in pdfs
+            if item.get('sbc_checked') or pdf[3] in ('deleted', 'gzipped')
+        ]
+
+        self.queue.put((page, pdfs, checks))
         return item
 
 
-    def save_scrape_metadata(self, item_df, csv_name):
+    def write_rows(self):
+        '''
+        Writer thread: batch rows from the queue until the None sentinel
         '''
-        Wrapper for scraped urls + metadata to csv. Note that this
-        method appends to a file if the file exists.
 
-        Takes:
-        - dataframe chunk to write
-        - string name of csv file
-        Returns:
-        - None
+        dbconn = sqlite3.connect(self.db_path, timeout=30)
+        pages, pdfs, checks = [], [], []
+        done = False
+
+        while not done:
+            try:
+                entry = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                entry = False
+
+            if entry is None:
+                done = True
+            elif entry:
+                pages.append(entry[0])
+                pdfs.extend(entry[1])
+                checks.extend(entry[2])
+
+            if pages and (done or entry is False or len(pages) >= self.batch_size):
+                try:
+                    self.insert_batch(dbconn, pages, pdfs, checks)
+                except sqlite3.Error as e:
+                    self.error = e
+                    reactor.callFromThread(self.fail, e, len(pages), len(pdfs))
+                    break
+                pages, pdfs, checks = [], [], []
+
+        dbconn.close()
+
+
+    def insert_batch(self, dbconn, pages, pdfs, checks):
+        '''
+        Write one batch in a transaction. While another writer (a shard,
+        identify_sbc.py) holds the lock, wait and try again, doubling the
+        wait each time; other errors are raised.
+        '''
+
+        for attempt in range(self.write_retries + 1):
+            try:
+                with dbconn:
+                    dbconn.executemany(self.insert_page, pages)
+                    dbconn.executemany(self.insert_pdf, pdfs)
+                    dbconn.executemany(self.insert_check, checks)
+                return
+            except sqlite3.OperationalError as e:
+                locked = 'locked' in str(e) or 'busy' in str(e)
+                if not locked or attempt == self.write_retries:
+                    raise
+                wait = 2 ** attempt
+                logger.warning(f"DB is locked ({e}); retrying {len(pages)} pages in {wait}s")
+                time.sleep(wait)
+
+
+    def fail(self, error, num_pages, num_pdfs):
+        '''
+        Close the spider when a batch can't be written, rather than crawl
+        on without recording what it finds
         '''
 
-        with open(csv_name, 'a', newline='') as f:
+        logger.error(f"could not write {num_pages} pages and {num_pdfs} pdfs to the DB: {error!r}")
+        engine = self.crawler.engine
+        if hasattr(engine, 'close_spider_async'):
+            return deferred_from_coro(engine.close_spider_async(reason='sqlite_error'))
+        return engine.close_spider(self.crawler.spider, 'sqlite_error')
 
-            writer = csv.writer(f)
-            for _, row in item_df.iterrows():
-                writer.writerow(row)
 
-        return
\ No newline at end of file
+    def update_gov_info(self, spider):
+        dbconn = sqlite3.connect(self.db_path, timeout=30)
+        with dbconn:
+            dbconn.execute(self.update_pdf_count)
+            dbconn.execute(self.update_scraped)
+        dbconn.close()
+        spider.logger.info("updated pdf and scrape counts in gov_info")
+
+
+class ParquetPipeline(object):
+    '''
+    Pipeline class that writes the scrape metadata (one row per crawled
+    url) to a compressed parquet file next to the csvs, so analysis can
+    read just the columns it needs. Rows are buffered and written as a
+    row group every PARQUET_ROW_GROUP_SIZE rows; base_domain and file_type
+    are dictionary encoded. Needs pyarrow and the PARQUET_ENABLED setting.
+    '''
+
+    columns = SCRAPE_COLUMNS + ['run_id']
+    dictionary_columns = ['base_domain', 'file_type']
+
+    def __init__(self, scraped_data_path, row_group_size=10000, compression='zstd'):
+        self.path = os.path.join(
+            scraped_data_path,
+            SbcscrapePipeline.run_timestamp + SCRAPE_PARQUET_NAME,
+        )
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.schema = pa.schema([(col, pa.string()) for col in self.columns])
+        self.rows = {col: [] for col in self.columns}
+        self.writer = None
+
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PARQUET_ENABLED'):
+            raise NotConfigured
+        if pa is None:
+            logger.warning("PARQUET_ENABLED is set but pyarrow isn't installed")
+            raise NotConfigured
+        return cls(
+            crawler.settings.get('SCRAPED_DATA_PATH', SCRAPED_DATA_PATH),
+            crawler.settings.getint('PARQUET_ROW_GROUP_SIZE', 10000),
+            crawler.settings.get('PARQUET_COMPRESSION', 'zstd'),
+        )
+
+
+    def open_spider(self, spider):
+        self.writer = pq.ParquetWriter(
+            self.path,
+            self.schema,
+            compression=self.compression,
+            use_dictionary=self.dictionary_columns,
+        )
+
+
+    def close_spider(self, spider):
+        self.write_row_group()
+        self.writer.close()
+
+
+    def process_item(self, item, spider):
+        for col in SCRAPE_COLUMNS:
+            value = as_text(item.get(col))
+            self.rows[col].append(None if value is None else str(value))
+        self.rows['run_id'].append(spider.run_id)
+
+        if len(self.rows['url']) >= self.row_group_size:
+            self.write_row_group()
+
+        return item
+
+
+    def write_row_group(self):
+        if not self.rows['url']:
+            return
+        self.writer.write_table(pa.Table.from_pydict(self.rows, schema=self.schema))
+        self.rows = {col: [] for col in self.columns}
+
+
+def as_text(value):
+    '''
+    Headers come through as bytes; store them as text
+    '''
+
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
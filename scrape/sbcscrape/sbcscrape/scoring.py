@@ -0,0 +1,83 @@
+"""
+Score links by how likely they are to lead to an SBC form. The score
+is added to the request priority so benefits pages and pdfs are
+fetched before the rest of a site.
+"""
+
+import re
+
+from urllib.parse import unquote, urlparse
+
+
+# default weights; override with the LINK_SCORE_TERMS setting
+DEFAULT_TERMS = {
+    'summary of benefits': 20,
+    'sbc': 15,
+    'benefits': 10,
+    'benefit': 10,
+    'human resources': 10,
+    'open enrollment': 10,
+    'insurance': 8,
+    'hr': 5,
+    'health': 5,
+    'employee': 4,
+    'medical': 4,
+    'plan': 2,
+    'agenda': -5,
+    'minutes': -5,
+    'budget': -5,
+    'calendar': -5,
+}
+PDF_BONUS = 5
+
+# separators in urls that stand in for spaces between words
+SEPARATORS = re.compile(r'[\W_]+')
+
+
+class LinkScorer(object):
+    '''
+    Scores a link from its url and anchor text. Each term counts once,
+    matched on whole words after url separators are turned into spaces,
+    so "human-resources" and "Human Resources" both match.
+    '''
+
+    def __init__(self, terms=None, pdf_bonus=PDF_BONUS):
+        terms = terms or DEFAULT_TERMS
+        self.patterns = [
+            (re.compile(r'\b' + r'\s+'.join(map(re.escape, term.split())) + r'\b'), weight)
+            for term, weight in terms.items()
+        ]
+        self.pdf_bonus = pdf_bonus
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.getdict('LINK_SCORE_TERMS') or None,
+            settings.getint('LINK_SCORE_PDF_BONUS', PDF_BONUS),
+        )
+
+    def normalize(self, text):
+        return SEPARATORS.sub(' ', unquote(text or '')).lower()
+
+    def score(self, url, anchor_text=''):
+        '''
+        Takes:
+        - string url
+        - string anchor text of the link, if any
+        Returns:
+        - int score, higher is more likely to lead to an SBC
+        '''
+
+        parsed = urlparse(url)
+        text = ' '.join([
+            self.normalize(parsed.path),
+            self.normalize(parsed.query),
+            self.normalize(anchor_text),
+        ])
+
+        score = sum(weight for pattern, weight in self.patterns if pattern.search(text))
+
+        if parsed.path.lower().endswith('.pdf'):
+            score += self.pdf_bonus
+
+        return score
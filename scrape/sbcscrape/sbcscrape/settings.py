@@ -14,12 +14,45 @@ NEWSPIDER_MODULE = 'sbcscrape.spiders'
 
 FILES_PATH = '/data/data/webscraping/scraped_data/'
 
+# database with the gov_info table the spider reads its start urls from
+DB_PATH = '/data/data/webscraping/sbc_db_2022.sqlite'
+
+# units claimed by a run that never finished can be reclaimed after this long
+CLAIM_EXPIRY_HOURS = 24
+
 # crawl in BFO rather than DFO for broad crawling efficiency
 DEPTH_PRIORITY = 1
+
+# links are also scored on url + anchor text terms (see scoring.py) and the
+# score is added to their priority, so benefits pages and pdfs go first.
+# LINK_SCORE_TERMS = {'benefits': 10, 'open enrollment': 10, 'agenda': -5}
+LINK_SCORE_PDF_BONUS = 5
+
+# Requests are fingerprinted on a canonical form of their url, so session
+# ids, tracking parameters, host casing and index pages don't cause repeat
+# fetches. The requested url itself is unchanged. Defaults are in canonical.py.
+REQUEST_FINGERPRINTER_CLASS = 'sbcscrape.canonical.CanonicalRequestFingerprinter'
+# CANONICAL_STRIP_PARAMS = ['jsessionid', 'phpsessid', 'utm_*', 'fbclid']
+# CANONICAL_INDEX_PAGES = ['index.aspx', 'default.aspx', 'index.html']
+# CANONICAL_CASE_INSENSITIVE_EXTENSIONS = ['.aspx', '.ashx', '.asp']
+
+# Seed each unit from the sitemaps in its robots.txt (or /sitemap.xml) before
+# crawling its pages; only entries scoring at least SITEMAP_MIN_SCORE are kept
+SITEMAP_FIRST = False
+SITEMAP_MIN_SCORE = 5
+SITEMAP_MAX_CHILDREN = 50
+SITEMAP_PRIORITY = 100
+
 SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
 SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
 SCHEDULER_PRIORITY_QUEUE = 'scrapy.pqueues.DownloaderAwarePriorityQueue'
 
+# Pass a job directory per crawl to make it resumable, e.g.
+#   scrapy crawl sbc_spider -s JOBDIR=/data/data/webscraping/crawls/run-1
+# Pending requests go to the disk queue above and rerunning the same command
+# picks up where it stopped. Use a new directory for each new crawl.
+#JOBDIR = '/data/data/webscraping/crawls/run-1'
+
 # Follow links on original page, plus links on first level subpage, then stop
 DEPTH_LIMIT=2
 
@@ -63,31 +96,143 @@ DOWNLOAD_TIMEOUT = 30
 
 SPIDER_MIDDLEWARES = {
     'sbcscrape.middlewares.SaveErrorsMiddleware': 1000,
+    'sbcscrape.middlewares.UnitLedgerMiddleware': 10,
+    'sbcscrape.middlewares.CrawlTrapMiddleware': 50,
 }
 
+# Drop followed links once a domain has requested this many urls with the
+# same path/query template (calendar days, pagination, search facets), and
+# links that repeat a path segment more than TRAP_MAX_SEGMENT_REPEATS times.
+# Tripped templates are recorded in the crawl_traps table. 0 disables a check.
+TRAP_TEMPLATE_CAP = 200
+TRAP_MAX_SEGMENT_REPEATS = 3
+# links whose path matches one of these regexes (pdfs, document handlers)
+# are exempt from TRAP_TEMPLATE_CAP; defaults are in middlewares.py
+# TRAP_DOCUMENT_PATTERNS = [r'\.pdf$', r'document', r'download']
+
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 
 # Virginia- do not retry 500 error messages
 DOWNLOADER_MIDDLEWARES = {
    'sbcscrape.middlewares.SbcscrapeDownloaderMiddleware': 543,
+   'sbcscrape.middlewares.DomainBudgetMiddleware': 50,
+   'sbcscrape.middlewares.PdfRangeProbeMiddleware': 60,
 }
 
+# Fetch only the first chunk of .pdf links and download the whole file only
+# if the chunk has the SBC title (or can't be read)
+PDF_RANGE_PROBE_ENABLED = False
+PDF_RANGE_PROBE_BYTES = 262144
+# threads for checking chunks, separate from the reactor's pool
+PDF_RANGE_PROBE_THREADS = 2
+
+# Per base domain crawl budgets; 0 means unlimited. Once one is spent,
+# the rest of that domain's requests are skipped
+DOMAIN_BUDGET_PAGES = 0
+DOMAIN_BUDGET_PDFS = 0
+DOMAIN_BUDGET_BYTES = 0
+# stop a domain after this many confirmed SBCs (needs SBC_CHECK_ENABLED)
+DOMAIN_BUDGET_SBCS = 0
+
+# check pdfs for the SBC title as they're saved (see SbcCheckPipeline)
+SBC_CHECK_ENABLED = False
+SBC_TITLE_TEXT = 'Summary of Benefits and Coverage'
+# threads for the SBC check, separate from the reactor's pool used for DNS
+SBC_CHECK_THREADS = 2
+
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'sbcscrape.extensions.AdaptiveThrottle': 500,
+    'sbcscrape.extensions.DnsPreflight': 510,
+    'sbcscrape.extensions.DomainTelemetry': 520,
+    'sbcscrape.extensions.DiskWatermark': 530,
+}
+
+# Per base domain requests, bytes, latency, status codes, pdfs, depth and
+# wall time, written to the crawl_telemetry table every interval (seconds)
+TELEMETRY_ENABLED = True
+TELEMETRY_FLUSH_INTERVAL = 60
+
+# Resolve every pending unit's start url host before the crawl starts. Good
+# lookups warm the DNS cache; units on hosts that don't resolve are skipped
+# and marked dns_failed in scrape_ledger. Lookups run in the reactor's
+# thread pool, so it is sized to allow DNS_PREFLIGHT_CONCURRENCY at once.
+DNS_PREFLIGHT_ENABLED = True
+DNS_PREFLIGHT_CONCURRENCY = 20
+REACTOR_THREADPOOL_MAXSIZE = 20
+DNSCACHE_SIZE = 50000
+
+# Tune concurrency and delay per domain from observed latency and errors
+# (see extensions.AdaptiveThrottle). DOWNLOAD_DELAY is the starting delay
+# and CONCURRENT_REQUESTS still caps the whole crawl
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_MIN_CONCURRENCY = 1
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 16
+ADAPTIVE_THROTTLE_MIN_DELAY = 0
+ADAPTIVE_THROTTLE_MAX_DELAY = 10
+ADAPTIVE_THROTTLE_TARGET_LATENCY = 2
+# latency that counts as a near-timeout, defaults to half of DOWNLOAD_TIMEOUT
+#ADAPTIVE_THROTTLE_SLOW_LATENCY = 15
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     'sbcscrape.pipelines.SbcscrapePipeline': 300,
-    'scrapy.pipelines.files.FilesPipeline': 1,
+    # saves the pdf body the spider already fetched; swap back to
+    # 'scrapy.pipelines.files.FilesPipeline' to download files separately
+    'sbcscrape.pipelines.PrefetchedFilesPipeline': 1,
+    'sbcscrape.pipelines.SbcCheckPipeline': 2,
+    'sbcscrape.pipelines.StorageReclaimPipeline': 3,
+    'sbcscrape.pipelines.SqliteResultsPipeline': 310,
+    'sbcscrape.pipelines.ParquetPipeline': 320,
 }
 
+# Stream pages and pdfs into latest_scrape and scraped_pdfs as they are
+# scraped (replaces ingest_scrape_results.py; the csvs are still written)
+SQLITE_RESULTS_ENABLED = True
+SQLITE_BATCH_SIZE = 500
+SQLITE_FLUSH_INTERVAL = 5
+# retries, with doubling waits from 1s, for a batch that finds the DB locked
+SQLITE_WRITE_RETRIES = 5
+# directory path_to_pdf is built from; defaults to FILES_STORE
+#SQLITE_PDF_ROOT = '/data/storage/pdfs/'
+
+# Also write the scrape metadata to a compressed parquet file in
+# SCRAPED_DATA_PATH (needs pyarrow)
+PARQUET_ENABLED = False
+PARQUET_ROW_GROUP_SIZE = 10000
+PARQUET_COMPRESSION = 'zstd'
+
 FILES_STORE = '/data/storage/pdfs/'
 
+# Index of stored pdfs by checksum, shared by every survey year's crawl, so
+# content we already have is hardlinked and keeps its SBC verdict
+CONTENT_INDEX_ENABLED = True
+CONTENT_INDEX_DB = '/data/data/webscraping/pdf_index.sqlite'
+
+# Delete ('delete') or compress ('gzip') pdfs as soon as they are known not
+# to be SBCs (needs SBC_CHECK_ENABLED). With reclaiming on, the crawl also
+# pauses while the FILES_STORE or HTTPCACHE_DIR disk is over DISK_HIGH_WATER
+# full, resumes under DISK_LOW_WATER, and closes with reason disk_full after
+# DISK_PAUSE_MAX_SECS (0 = wait).
+RECLAIM_ENABLED = False
+RECLAIM_ACTION = 'delete'
+# threads for deleting or gzipping, separate from the reactor's pool
+RECLAIM_THREADS = 1
+DISK_HIGH_WATER = 0.9
+DISK_LOW_WATER = 0.85
+DISK_CHECK_INTERVAL = 30
+DISK_PAUSE_MAX_SECS = 3600
+
+# where SbcscrapePipeline writes the url and pdf metadata csvs; rows are
+# buffered and appended every METADATA_BATCH_SIZE rows or FLUSH_INTERVAL secs
+SCRAPED_DATA_PATH = '/data/data/webscraping/scraped_data/'
+METADATA_BATCH_SIZE = 500
+METADATA_FLUSH_INTERVAL = 30
+
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -104,8 +249,15 @@ FILES_STORE = '/data/storage/pdfs/'
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = 'httpcache'
+# The cache is kept on disk across runs and survey years. The RFC2616 policy
+# only stores responses that carry an ETag, Last-Modified or expiry, and
+# revalidates them with If-None-Match / If-Modified-Since, so a 304 is
+# served from the cache instead of downloading the body again. Pdfs are
+# not cached, since their bodies are already kept in FILES_STORE
+HTTPCACHE_ENABLED = True
+HTTPCACHE_POLICY = 'sbcscrape.extensions.PageCachePolicy'
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = '/data/storage/httpcache/'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_GZIP = True
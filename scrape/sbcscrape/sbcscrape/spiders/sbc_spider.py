@@ -14,25 +14,48 @@ Defines spider for locating and saving SBC form candidates
 #to add handle exceptions
 # https://www.tutorialspoint.com/scrapy/scrapy_requests_and_responses.htm
 
+import datetime
+import itertools
 import sqlite3
-from tkinter.messagebox import IGNORE
-import pandas as pd
+import zlib
 
-from urllib.parse import urlparse
+from urllib.parse import urljoin, urlparse
 
+from scrapy import Request
+from scrapy.http import XmlResponse
 from scrapy.linkextractors import LinkExtractor
 from scrapy.linkextractors import IGNORED_EXTENSIONS
-from scrapy.spidermiddlewares.httperror import HttpError 
+from scrapy.robotstxt import ProtegoRobotParser
 from scrapy.spiders import CrawlSpider, Rule
+from scrapy.utils.gz import gunzip, gzip_magic_number
+from scrapy.utils.sitemap import Sitemap
+from scrapy.utils.url import url_is_from_any_domain
 from scrapy import signals
 
-from twisted.internet.error import DNSLookupError 
-from twisted.internet.error import TimeoutError 
- 
+from sbcscrape.ledger import UnitLedger
+from sbcscrape.scoring import LinkScorer
 
-# TODO: CONFIG THIS?
+
+# default DB, can be overridden with the DB_PATH setting
 DB = "/data/data/webscraping/sbc_db_2022.sqlite"
 DEV_URLS = ['https://www.rsa-al.gov/peehip/publications/']
+# meta stamped on start requests and carried to every child request
+UNIT_META_KEYS = ('base_domain', 'id_idcd_plant', 'start_url')
+
+
+def shard_of(domain, num_shards):
+    '''
+    Stable shard assignment so a domain always lands in the same crawler
+    process, whatever the run (python's hash() is salted per process)
+
+    Takes:
+    - string domain (netloc of the start url)
+    - int number of shards
+    Returns:
+    - int shard number in [0, num_shards)
+    '''
+
+    return zlib.crc32(domain.lower().encode('utf-8')) % num_shards
 
 
 class SbcSpider(CrawlSpider):
@@ -41,59 +64,384 @@ class SbcSpider(CrawlSpider):
         'LOG_LEVEL': 'INFO',
     }
     
-    batch_size = 30 # scrapy doesn't handle long start_urls lists well, so we batch
+    batch_size = 30 # rows pulled from gov_info per page of start requests
     query = '''
             SELECT id_idcd_plant,
                     MNAME,
                     start_url
             FROM gov_info
             WHERE start_url IS NOT NULL AND
-            is_scraped=0 
+            is_scraped=0 AND
+            (scrape_claimed_at IS NULL OR
+                scrape_claimed_by=? OR
+                scrape_claimed_at < ?) AND
+            id_idcd_plant NOT IN (
+                SELECT id_idcd_plant
+                FROM scrape_ledger
+                WHERE status='finished'
+            ) AND
+            id_idcd_plant > ?
+            ORDER BY id_idcd_plant
             LIMIT ?;
             '''
 
-    dbconn = sqlite3.connect(DB)
-    cur = dbconn.cursor()
-    cur.execute(query, (batch_size, ))
-    cols = ['id_idcd_plant', 'MNAME', 'start_url', ]
-    to_scrape = pd.DataFrame(cur.fetchall(), columns = cols)
-
-    start_urls = to_scrape['start_url'].to_list()
-    # start_urls = DEV_URLS
-    
-    # get unique domains of all start urls, restrict to these
-    domains = set([urlparse(url).netloc for url in start_urls])
-
+    claim = '''
+            UPDATE gov_info
+            SET scrape_claimed_by=?,
+                scrape_claimed_at=?
+            WHERE id_idcd_plant=? AND
+            (scrape_claimed_at IS NULL OR
+                scrape_claimed_by=? OR
+                scrape_claimed_at < ?);
+            '''
 
     rules = (
         Rule(
             LinkExtractor(
                 unique=True,
-                allow_domains = domains,
                 deny_extensions=[i for i in IGNORED_EXTENSIONS if i!="pdf"],
             ),
             callback='parse_item',
             follow=True,
+            process_request='process_link_request',
+            errback='handle_request_error',
         ),
     )
 
     
     # output failed start_url in Scrapy stats https://stackoverflow.com/questions/13724730/how-to-get-the-scrapy-failure-urls 
-    def __init__(self, *args, **kwargs):
+    # shard/num_shards come from `scrapy crawl -a`, see scrape/crawl_shards.py
+    def __init__(self, *args, shard=0, num_shards=1, **kwargs):
         super().__init__(*args, **kwargs)
         self.failed_urls = []
-
-        self.logger.info(f"df has dimensions {self.to_scrape.shape}")
+        # domains of all claimed start urls; grows as start requests are fed
+        self.domains = set()
+        # hosts DnsPreflight couldn't resolve; their units are skipped
+        self.dead_hosts = set()
+        self.shard = int(shard)
+        self.num_shards = int(num_shards)
+        self.run_id = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        if self.num_shards > 1:
+            self.run_id += f"_shard{self.shard}"
 
 
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super(SbcSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.link_scorer = LinkScorer.from_settings(crawler.settings)
+        spider.ensure_claim_columns(crawler.settings.get('DB_PATH', DB))
+        spider.ledger = UnitLedger(crawler.settings.get('DB_PATH', DB), spider.logger)
         crawler.signals.connect(spider.handle_spider_closed, signals.spider_closed)
+        crawler.signals.connect(spider.ledger.request_dropped, signals.request_dropped)
+        if crawler.settings.getbool('SITEMAP_FIRST'):
+            crawler.signals.connect(spider.robots_parsed, signals.robots_parsed)
         return spider
 
 
+    def ensure_claim_columns(self, db_path):
+        '''
+        Add the claim columns to gov_info in databases made before they
+        were in the schema. Runs when the crawler is built, so a database
+        without gov_info stops the crawl before it starts.
+
+        Takes:
+        - string path to the database
+        Returns:
+        - None
+        '''
+
+        dbconn = sqlite3.connect(db_path, timeout=30)
+        columns = [row[1] for row in dbconn.execute("PRAGMA table_info('gov_info');")]
+        if not columns:
+            dbconn.close()
+            raise sqlite3.OperationalError(f"no gov_info table in {db_path}")
+
+        with dbconn:
+            for column in ('scrape_claimed_by', 'scrape_claimed_at'):
+                if column not in columns:
+                    self.logger.info(f"adding {column} to gov_info")
+                    dbconn.execute(f'ALTER TABLE gov_info ADD COLUMN {column} TEXT;')
+        dbconn.close()
+
+
+    async def start(self):
+        '''
+        Scrapy >= 2.13 entry point; defers to start_requests so both
+        old and new versions page through gov_info the same way
+        '''
+
+        for request in self.start_requests():
+            yield request
+
+
+    def start_requests(self):
+        '''
+        Lazily page through unscraped units in gov_info and yield one start
+        request per unit. Scrapy only pulls from this generator when the
+        scheduler has room, so we never hold more than one page of rows.
+
+        Each unit is claimed (scrape_claimed_by/scrape_claimed_at) before
+        its request is yielded so concurrent or restarted runs skip it.
+        Claims older than CLAIM_EXPIRY_HOURS are treated as abandoned, and
+        units the scrape_ledger lists as finished are skipped.
+
+        When the crawl runs with a JOBDIR, the run id is kept in the job
+        state, so a resumed job picks up its own unfinished claims on top
+        of the frontier Scrapy restores from disk.
+
+        With SITEMAP_FIRST on, the sitemaps in each unit's robots.txt seed
+        the crawl (see robots_parsed).
+
+        When run as one of several shards, units whose start url domain
+        hashes to another shard are left for that shard's process.
+
+        Yields:
+        - scrapy Request for each claimed start url
+        '''
+
+        dbconn = sqlite3.connect(self.settings.get('DB_PATH', DB), timeout=30)
+        expiry_hours = self.settings.getfloat('CLAIM_EXPIRY_HOURS', 24)
+        sitemap_first = self.settings.getbool('SITEMAP_FIRST')
+
+        # spider.state only exists (and persists) when JOBDIR is set
+        if hasattr(self, 'state'):
+            self.run_id = self.state.setdefault('run_id', self.run_id)
+        self.ledger.run_id = self.run_id
+
+        last_id = ''
+        while True:
+
+            expired_before = (datetime.datetime.now() - \
+                datetime.timedelta(hours=expiry_hours)).isoformat(timespec='seconds')
+
+            cur = dbconn.cursor()
+            cur.execute(self.query, (self.run_id, expired_before, last_id, self.batch_size, ))
+            rows = cur.fetchall()
+            cur.close()
+
+            if not rows:
+                break
+
+            self.logger.info(f"fetched {len(rows)} units to scrape after id {last_id!r}")
+
+            for id_idcd_plant, mname, start_url in rows:
+
+                last_id = id_idcd_plant
+
+                if self.num_shards > 1 and \
+                    shard_of(urlparse(start_url).netloc, self.num_shards) != self.shard:
+                    continue
+
+                if urlparse(start_url).hostname in self.dead_hosts:
+                    self.crawler.stats.inc_value('units_skipped/dns_failed')
+                    continue
+
+                # claim the unit; another process may have beaten us to it
+                now = datetime.datetime.now().isoformat(timespec='seconds')
+                cur = dbconn.cursor()
+                cur.execute(self.claim, (self.run_id, now, id_idcd_plant, self.run_id, expired_before, ))
+                claimed = cur.rowcount == 1
+                cur.close()
+                dbconn.commit()
+
+                if not claimed:
+                    continue
+
+                self.crawler.stats.inc_value('units_claimed')
+                self.ledger.start_unit(id_idcd_plant)
+                base_domain = urlparse(start_url).netloc
+                self.domains.add(base_domain)
+
+                meta = {
+                    'base_domain': base_domain,
+                    'id_idcd_plant': id_idcd_plant,
+                    'start_url': start_url,
+                }
+
+                # without RobotsTxtMiddleware there's no robots.txt to
+                # read sitemaps from, so try the usual location
+                if sitemap_first and not self.settings.getbool('ROBOTSTXT_OBEY'):
+                    sitemap = self.sitemap_request(urljoin(start_url, '/sitemap.xml'), meta)
+                    self.ledger.count(sitemap)
+                    yield sitemap
+
+                # the unit is only finished if its start request succeeds
+                request = Request(
+                    start_url,
+                    dont_filter=True,
+                    errback=self.handle_request_error,
+                    meta=dict(meta, ledger_start=True),
+                )
+                self.ledger.count(request)
+
+                yield request
+
+        dbconn.close()
+
+
+    def process_link_request(self, request, response):
+        '''
+        Keep followed links inside the domains of the claimed start urls.
+        Replaces the allow_domains list that used to be fixed when the
+        class was defined. Also carries the unit's ID, start url and base
+        domain down to child requests (see unit_meta) so items, budgets
+        and the unit ledger can find them, and raises the priority of
+        links that look like they lead to SBCs.
+
+        Takes:
+        - request built from an extracted link
+        - response the link was extracted from
+        Returns:
+        - the request, or None to drop it
+        '''
+
+        if url_is_from_any_domain(request.url, self.domains):
+            request.meta.update(self.unit_meta(response))
+            request.priority += self.link_scorer.score(request.url, request.meta.get('link_text', ''))
+            return request
+
+        return None
+
+
+    def unit_meta(self, response):
+        '''
+        Takes:
+        - response (or request)
+        Returns:
+        - dict of the unit keys from the response's meta, for child requests
+        '''
+
+        return {key: response.meta[key] for key in UNIT_META_KEYS if key in response.meta}
+
+
+    def robots_parsed(self, robotparser, request):
+        '''
+        Queue the sitemaps a site lists in robots.txt, as parsed by
+        RobotsTxtMiddleware, falling back to /sitemap.xml when it lists
+        none (or has no robots.txt). Runs once per host, before the
+        request that made the middleware fetch robots.txt is downloaded.
+
+        Takes:
+        - RobotParser the middleware built
+        - request that made it fetch robots.txt
+        Returns:
+        - None
+        '''
+
+        meta = self.unit_meta(request)
+        if not meta:
+            return
+
+        sitemap_urls = []
+        # only Protego (the default ROBOTSTXT_PARSER) keeps the sitemaps
+        if isinstance(robotparser, ProtegoRobotParser):
+            sitemap_urls = [urljoin(request.url, url) for url in robotparser.rp.sitemaps]
+
+        if not sitemap_urls:
+            sitemap_urls = [urljoin(request.url, '/sitemap.xml')]
+
+        for url in sitemap_urls:
+            if url_is_from_any_domain(url, self.domains):
+                sitemap = self.sitemap_request(url, meta)
+                self.ledger.count(sitemap)
+                self.crawler.engine.crawl(sitemap)
+
+
+    def sitemap_request(self, url, meta):
+        '''
+        Takes:
+        - string sitemap url
+        - dict of the unit keys for the request's meta
+        Returns:
+        - Request for the sitemap, ahead of the unit's pages
+        '''
+
+        return Request(
+            url,
+            callback=self.parse_sitemap,
+            errback=self.handle_request_error,
+            priority=self.settings.getint('SITEMAP_PRIORITY'),
+            meta=dict(meta),
+        )
+
+
+    def get_sitemap_body(self, response):
+        '''
+        Takes:
+        - response
+        Returns:
+        - sitemap xml as bytes, or None if the response isn't a sitemap
+        '''
+
+        if isinstance(response, XmlResponse):
+            return response.body
+        if gzip_magic_number(response):
+            try:
+                return gunzip(response.body, max_size=self.settings.getint('DOWNLOAD_MAXSIZE'))
+            except Exception:
+                return None
+        if response.url.lower().endswith(('.xml', '.xml.gz')):
+            return response.body
+        return None
+
+
+    def parse_sitemap(self, response):
+        '''
+        Seed the crawl from a sitemap. Nested sitemaps are followed (up to
+        SITEMAP_MAX_CHILDREN per index); page and pdf entries are kept only
+        if LinkScorer rates them at least SITEMAP_MIN_SCORE, and their score
+        becomes their priority.
+
+        Entries are crawled as if they were start urls, so pdfs and pages
+        deep in a site still get the full DEPTH_LIMIT of link following.
+
+        Yields:
+        - requests for nested sitemaps and relevant entries
+        '''
+
+        body = self.get_sitemap_body(response)
+        if body is None:
+            self.logger.debug(f"not a sitemap: {response.url}")
+            return
+
+        try:
+            sitemap = Sitemap(body)
+        except Exception as e:
+            self.logger.debug(f"could not parse sitemap {response.url}: {e!r}")
+            return
+
+        # DepthMiddleware starts these back at depth 0
+        meta = dict(self.unit_meta(response), depth_reset=True)
+        min_score = self.settings.getint('SITEMAP_MIN_SCORE')
+
+        if sitemap.type == 'sitemapindex':
+            max_children = self.settings.getint('SITEMAP_MAX_CHILDREN')
+            for entry in itertools.islice(sitemap, max_children):
+                if url_is_from_any_domain(entry['loc'], self.domains):
+                    yield Request(
+                        entry['loc'],
+                        callback=self.parse_sitemap,
+                        errback=self.handle_request_error,
+                        priority=response.request.priority,
+                        meta=dict(meta),
+                    )
+
+        elif sitemap.type == 'urlset':
+            for entry in sitemap:
+                url = entry['loc']
+                score = self.link_scorer.score(url)
+                if score < min_score or not url_is_from_any_domain(url, self.domains):
+                    continue
+                self.crawler.stats.inc_value('sitemap/entries_kept')
+                yield Request(
+                    url,
+                    errback=self.handle_request_error,
+                    priority=score,
+                    meta=dict(meta),
+                )
+
+
     def get_original_url(self, response):
         '''
         Sometimes urls redirect, but we want to keep track of original domain
@@ -123,6 +471,17 @@ class SbcSpider(CrawlSpider):
 
         self.logger.info(f"Spider closed: {reason}")
         self.crawler.stats.set_value('failed_urls', ', '.join(self.failed_urls))
+        self.ledger.close(reason)
+
+
+    def handle_request_error(self, failure):
+        '''
+        Errback for start and followed requests: settle the request in the
+        unit ledger, then hand the failure back so Scrapy logs it as usual
+        '''
+
+        self.ledger.settle(failure.request)
+        return failure
 
 
     def parse_item(self, response):
@@ -133,8 +492,12 @@ class SbcSpider(CrawlSpider):
         - referring url: if there was one, from where did we get to this page?
         - url: the response url of the page scraped
         - base_domain: the net location of the original url we used to get here
+        - id_idcd_plant: ID of the government unit whose crawl found this page
+        - start_url: that unit's start url
         - file_type: content type from the response header
         - file_urls: list containing the urls of any pdf objects
+        - file_response: the pdf response itself, so the files pipeline
+            can save it without downloading it again
         '''
 
         self.logger.debug(f"allowed domains are: {self.domains}")
@@ -152,20 +515,27 @@ class SbcSpider(CrawlSpider):
 
         self.logger.debug(f"{base_domain}, {original_url}, {str(content_type)}")
 
-        # if there's a pdf extension, pass to pipeline
-        if "pdf" in str(content_type):
+        # if there's a pdf extension, pass to pipeline, unless the range
+        # probe already ruled it out as an SBC
+        probe_result = response.meta.get('pdf_probe')
+        if "pdf" in str(content_type) and probe_result != 'not_sbc':
             self.logger.info(f"pdf found from base domain {base_domain}")
             file_urls = [response.url,]
+            file_response = response
         else:
             file_urls = []
+            file_response = None
 
     
         yield  {
             'referring_url': response.request.headers.get('Referer', None),
             'url':response.url,
             'base_domain': base_domain,
+            'id_idcd_plant': response.meta.get('id_idcd_plant'),
+            'start_url': response.meta.get('start_url'),
             'file_type': content_type,
             'file_urls': file_urls,
+            'file_response': file_response,
             }
         
 
@@ -187,20 +557,27 @@ class SbcSpider(CrawlSpider):
 
         self.logger.debug(f"{base_domain}, {original_url}, {str(content_type)}")
 
-        # if there's a pdf extension, pass to pipeline
-        if "pdf" in str(content_type):
+        # if there's a pdf extension, pass to pipeline, unless the range
+        # probe already ruled it out as an SBC
+        probe_result = response.meta.get('pdf_probe')
+        if "pdf" in str(content_type) and probe_result != 'not_sbc':
             self.logger.info(f"pdf found from base domain {base_domain}")
             file_urls = [response.url,]
+            file_response = response
         else:
             file_urls = []
+            file_response = None
 
     
         yield  {
             'referring_url': response.request.headers.get('Referer', None),
             'url':response.url,
             'base_domain': base_domain,
+            'id_idcd_plant': response.meta.get('id_idcd_plant'),
+            'start_url': response.meta.get('start_url'),
             'file_type': content_type,
             'file_urls': file_urls,
+            'file_response': file_response,
             }
 
 
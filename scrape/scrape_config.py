@@ -14,6 +14,9 @@ SEARCH_TERM = "employee health insurance"
 # don't work inside the spider 
 SCRAPY_PDF_PATH = "/data/storage/pdfs/"
 SBC_PDF_PATH = "/data/storage/pdfs/sbc/"
+# must match CONTENT_INDEX_DB in sbcscrape/settings.py; None keeps
+# identify_sbc.py's verdicts in DB_PATH only
+CONTENT_INDEX_DB = "/data/data/webscraping/pdf_index.sqlite"
 
 # probably have to change these a lot
 SCRAPE_METADATA = "/data/data/webscraping/scraped_data/2022-09-23_1602_scrape_run_metadata.csv"
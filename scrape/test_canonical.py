@@ -0,0 +1,65 @@
+"""
+Tests for the canonical urls the dupefilter, http cache and files
+pipeline fingerprint requests on (sbcscrape/canonical.py).
+"""
+
+import os
+import sys
+
+import pytest
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+
+# the scrapy project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sbcscrape'))
+from sbcscrape.canonical import CanonicalRequestFingerprinter, UrlCanonicalizer
+
+
+@pytest.mark.parametrize('url, canonical', [
+    # host casing, default port, fragment, index page without a query
+    ('HTTP://WWW.Example.GOV:80/Benefits/index.html#top', 'http://www.example.gov/Benefits/'),
+    # tracking and session parameters, in any case; the rest sorted
+    ('https://a.gov/page.php?utm_source=x&b=2&a=1&JSESSIONID=9', 'https://a.gov/page.php?a=1&b=2'),
+    # session ids in the path
+    ('https://a.gov/app;jsessionid=ABC/page.jsp', 'https://a.gov/app/page.jsp'),
+    ('https://a.gov/(S(abc123))/Benefits.aspx', 'https://a.gov/benefits.aspx'),
+    # IIS handlers are case-insensitive
+    ('https://a.gov/ShowDocument.ashx?ID=12', 'https://a.gov/showdocument.ashx?id=12'),
+    # with a query the index page is a handler and is kept
+    ('https://a.gov/Index.aspx?ID=3', 'https://a.gov/index.aspx?id=3'),
+    # query escapes that aren't utf-8 survive
+    ('https://a.gov/search?q=%E9', 'https://a.gov/search?q=%E9'),
+    ('https://a.gov:8443/x', 'https://a.gov:8443/x'),
+    ('mailto:hr@a.gov', 'mailto:hr@a.gov'),
+])
+def test_canonicalize(url, canonical):
+    assert UrlCanonicalizer().canonicalize(url) == canonical
+
+
+def test_strip_params_replace_defaults():
+    canonicalizer = UrlCanonicalizer(strip_params=['sessionkey'])
+
+    assert canonicalizer('https://a.gov/p?SessionKey=1&utm_source=x') == 'https://a.gov/p?utm_source=x'
+
+
+@pytest.fixture
+def fingerprinter():
+    return CanonicalRequestFingerprinter.from_crawler(get_crawler())
+
+
+def test_url_variants_share_a_fingerprint(fingerprinter):
+    request = Request('https://www.a.gov/benefits/')
+    variant = Request('https://www.a.gov/Benefits/Default.aspx?utm_source=newsletter#plans')
+
+    assert fingerprinter.fingerprint(request) == fingerprinter.fingerprint(variant)
+    # the url that is requested is left as it was linked
+    assert variant.url == 'https://www.a.gov/Benefits/Default.aspx?utm_source=newsletter#plans'
+
+
+def test_other_requests_keep_their_own_fingerprint(fingerprinter):
+    get = Request('https://a.gov/search?q=plans')
+
+    assert fingerprinter.fingerprint(get) != fingerprinter.fingerprint(Request('https://a.gov/search?q=forms'))
+    assert fingerprinter.fingerprint(get) != fingerprinter.fingerprint(
+        Request('https://a.gov/search?q=plans', method='POST', body=b'page=2')
+    )
@@ -0,0 +1,103 @@
+"""
+Tests for the tiered SBC title check in identify_sbc.py. The pdfs are
+built by hand so each test controls exactly where the title appears.
+"""
+
+import zlib
+
+import pytest
+
+from identify_sbc import check_sbc_title
+
+SBC_TITLE = b'Summary of Benefits and Coverage'
+
+
+def write_pdf(path, page_text, extra_objects=(), catalog_extra=b'', trailer_extra=b''):
+    '''
+    Write a one page pdf with a compressed content stream. Extra objects
+    are numbered from 6; catalog_extra and trailer_extra are added to the
+    catalog and trailer dicts so they can point at them.
+    '''
+
+    content = zlib.compress(b'BT /F1 12 Tf 72 720 Td (' + page_text + b') Tj ET')
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R ' + catalog_extra + b' >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> /Annots [] >>',
+        b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ] + list(extra_objects)
+
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for num, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % num + obj + b'\nendobj\n'
+
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R ' % (len(objects) + 1) + trailer_extra + b' >>\n'
+    out += b'startxref\n%d\n%%%%EOF\n' % xref
+
+    path.write_bytes(out)
+    return str(path)
+
+
+def test_outline_and_annotation_titles_are_not_the_document_title(tmp_path):
+    pdf = write_pdf(
+        tmp_path / 'budget.pdf',
+        b'Annual Budget Book',
+        extra_objects=[
+            b'<< /Type /Outlines /First 7 0 R /Last 7 0 R /Count 1 >>',
+            b'<< /Title (' + SBC_TITLE + b') /Parent 6 0 R /Dest [3 0 R /Fit] >>',
+            b'<< /Type /Annot /Subtype /Text /Rect [0 0 10 10] /T (' + SBC_TITLE + b') '
+            b'/Contents (' + SBC_TITLE + b') >>',
+        ],
+        catalog_extra=b'/Outlines 6 0 R',
+    )
+
+    assert check_sbc_title(pdf) == (False, 'layout')
+
+
+def test_info_title_in_utf16(tmp_path):
+    title = (b'\xfe\xff' + SBC_TITLE.decode().encode('utf-16-be')).hex().encode()
+    pdf = write_pdf(
+        tmp_path / 'sbc.pdf',
+        b'Plan year 2022',
+        extra_objects=[b'<< /Title <' + title + b'> >>'],
+        trailer_extra=b'/Info 6 0 R',
+    )
+
+    assert check_sbc_title(pdf) == (True, 'metadata')
+
+
+def test_xmp_title(tmp_path):
+    xmp = (
+        b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF><rdf:Description>'
+        b'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">' + SBC_TITLE + b'</rdf:li></rdf:Alt></dc:title>'
+        b'</rdf:Description></rdf:RDF></x:xmpmeta>'
+    )
+    pdf = write_pdf(
+        tmp_path / 'sbc.pdf',
+        b'Plan year 2022',
+        extra_objects=[b'<< /Type /Metadata /Subtype /XML /Length %d >>\nstream\n' % len(xmp) + xmp + b'\nendstream'],
+        catalog_extra=b'/Metadata 6 0 R',
+    )
+
+    assert check_sbc_title(pdf) == (True, 'metadata')
+
+
+def test_title_on_first_page(tmp_path):
+    pdf = write_pdf(tmp_path / 'sbc.pdf', SBC_TITLE + b': What this Plan Covers')
+
+    assert check_sbc_title(pdf) == (True, 'first_page')
+
+
+def test_not_a_pdf(tmp_path):
+    path = tmp_path / 'error.pdf'
+    path.write_bytes(b'<html>404</html>')
+
+    with pytest.raises(ValueError):
+        check_sbc_title(str(path))
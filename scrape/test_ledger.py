@@ -0,0 +1,146 @@
+"""
+Tests for UnitLedger in the scrapy project: requests are counted against
+their unit, settled once each, and the unit is written as finished or
+failed when its last request settles.
+"""
+
+import os
+import sqlite3
+import sys
+
+import pytest
+from scrapy import Request
+
+# the scrapy project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sbcscrape'))
+from sbcscrape.ledger import UnitLedger
+
+
+class Logger(object):
+
+    def info(self, msg):
+        pass
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'test.sqlite')
+    dbconn = sqlite3.connect(path)
+    dbconn.executescript(
+        '''
+        CREATE TABLE gov_info (
+          id_idcd_plant TEXT,
+          scrape_claimed_by TEXT,
+          scrape_claimed_at TEXT
+        );
+        INSERT INTO gov_info VALUES ('01', 'run-1', '2022-09-23T16:02:00');
+        '''
+    )
+    dbconn.close()
+    return path
+
+
+@pytest.fixture
+def ledger(db_path):
+    ledger = UnitLedger(db_path, Logger())
+    ledger.run_id = 'run-1'
+    ledger.start_unit('01')
+    yield ledger
+    ledger.dbconn.close()
+
+
+def unit_request(url, start=False):
+    meta = {'id_idcd_plant': '01'}
+    if start:
+        meta['ledger_start'] = True
+    return Request(url, meta=meta)
+
+
+def ledger_row(ledger):
+    return ledger.dbconn.execute(
+        'SELECT status, num_requests FROM scrape_ledger WHERE id_idcd_plant = ?;',
+        ('01', ),
+    ).fetchone()
+
+
+def claim(ledger):
+    return ledger.dbconn.execute(
+        'SELECT scrape_claimed_by, scrape_claimed_at FROM gov_info WHERE id_idcd_plant = ?;',
+        ('01', ),
+    ).fetchone()
+
+
+def test_creates_ledger_table(db_path):
+    UnitLedger(db_path, Logger()).dbconn.close()
+
+    dbconn = sqlite3.connect(db_path)
+    tables = [name for name, in dbconn.execute("SELECT name FROM sqlite_master WHERE type='table';")]
+    dbconn.close()
+
+    assert 'scrape_ledger' in tables
+
+
+def test_unit_finishes_when_last_request_settles(ledger):
+    start = unit_request('https://a.gov/', start=True)
+    ledger.count(start)
+    page = unit_request('https://a.gov/benefits')
+
+    # the start request's response yields a link before it is settled
+    ledger.count(page)
+    ledger.settle(start, responded=True)
+    assert ledger_row(ledger) == ('started', None)
+
+    ledger.settle(page, responded=True)
+    assert ledger_row(ledger) == ('finished', 2)
+    assert claim(ledger) == ('run-1', '2022-09-23T16:02:00')
+
+
+def test_request_is_counted_and_settled_once(ledger):
+    start = unit_request('https://a.gov/', start=True)
+    page = unit_request('https://a.gov/benefits')
+    ledger.count(start)
+    ledger.count(page)
+
+    # a retry carries the original's meta, so it isn't counted again
+    ledger.count(page)
+    ledger.settle(start, responded=True)
+    ledger.settle(start, responded=True)
+    assert ledger_row(ledger) == ('started', None)
+
+    ledger.settle(page)
+    assert ledger_row(ledger) == ('finished', 2)
+
+
+def test_failed_start_request_fails_unit_and_releases_claim(ledger):
+    start = unit_request('https://a.gov/', start=True)
+    ledger.count(start)
+    ledger.settle(start)
+
+    assert ledger_row(ledger) == ('failed', 1)
+    assert claim(ledger) == (None, None)
+
+
+def test_dropped_request_settles_without_response(ledger):
+    start = unit_request('https://a.gov/', start=True)
+    page = unit_request('https://a.gov/benefits')
+    ledger.count(start)
+    ledger.count(page)
+
+    # e.g. the scheduler dropped a duplicate
+    ledger.request_dropped(page, None)
+    assert ledger_row(ledger) == ('started', None)
+
+    ledger.settle(start, responded=True)
+    assert ledger_row(ledger) == ('finished', 2)
+
+
+@pytest.mark.parametrize('reason, status', [('finished', 'finished'), ('shutdown', 'started')])
+def test_close_finishes_started_units_only_on_clean_finish(ledger, db_path, reason, status):
+    ledger.count(unit_request('https://a.gov/', start=True))
+    ledger.close(reason)
+
+    dbconn = sqlite3.connect(db_path)
+    row = dbconn.execute('SELECT status FROM scrape_ledger WHERE id_idcd_plant = ?;', ('01', )).fetchone()
+    dbconn.close()
+
+    assert row == (status, )
@@ -0,0 +1,107 @@
+"""
+Tests for SbcCheckPool's handling of workers that run past their
+deadline, die mid-pdf, or are due a restart. The check itself is
+replaced with a stub that acts on the file name, so no pdfs are parsed.
+"""
+
+import os
+import time
+
+import pytest
+
+import identify_sbc
+from identify_sbc import SbcCheckPool
+
+
+def stub_check(id_idcd_plant, path_to_pdf, maxpages=3):
+    name = os.path.basename(path_to_pdf)
+    if name.startswith('hang'):
+        time.sleep(60)
+    if name.startswith('crash'):
+        os._exit(1)
+    if name.startswith('error'):
+        raise ValueError(f"not a pdf: {path_to_pdf}")
+    # the pid tells the tests which worker checked the file
+    return id_idcd_plant, path_to_pdf, os.getpid()
+
+
+@pytest.fixture(autouse=True)
+def stub(monkeypatch):
+    # workers are forked, so they inherit the stub
+    monkeypatch.setattr(identify_sbc, 'is_pdf_sbc_form', stub_check)
+
+
+def run(pool, paths):
+    tasks = [(n, '01', path) for n, path in enumerate(paths)]
+    return {key: (verdict, error) for key, _, verdict, error in pool.run(tasks)}
+
+
+def test_hung_worker_is_replaced():
+    pool = SbcCheckPool(processes=1, timeout=1, large_processes=0)
+
+    start = time.monotonic()
+    results = run(pool, ['hang.pdf', 'a.pdf', 'b.pdf'])
+
+    assert time.monotonic() - start < 10
+    assert results[0] == (None, "TimeoutError('no verdict after 1s')")
+    assert results[1][1] is None and results[2][1] is None
+
+
+def test_dead_worker_is_replaced():
+    pool = SbcCheckPool(processes=1, large_processes=0)
+
+    results = run(pool, ['crash.pdf', 'a.pdf'])
+
+    assert results[0] == (None, "RuntimeError('worker exited with code 1')")
+    assert results[1][1] is None
+
+
+def test_exceptions_come_back_as_text():
+    pool = SbcCheckPool(processes=1, large_processes=0)
+
+    results = run(pool, ['error.pdf', 'a.pdf'])
+
+    assert results[0] == (None, "ValueError('not a pdf: error.pdf')")
+    assert results[1][1] is None
+
+
+def test_worker_restarts_after_maxtasks():
+    pool = SbcCheckPool(processes=1, maxtasks=2, large_processes=0)
+
+    results = run(pool, ['a.pdf', 'b.pdf', 'c.pdf', 'd.pdf'])
+    pids = [results[key][0] for key in range(4)]
+
+    assert pids[0] == pids[1]
+    assert pids[2] == pids[3]
+    assert pids[1] != pids[2]
+
+
+def test_large_pdfs_get_their_own_deadline(tmp_path):
+    large = tmp_path / 'hang_large.pdf'
+    large.write_bytes(b'%PDF-' + b'0' * 1024)
+    pool = SbcCheckPool(processes=1, timeout=30, large_size=1024, large_timeout=1)
+
+    start = time.monotonic()
+    results = run(pool, [str(large), 'a.pdf'])
+
+    assert time.monotonic() - start < 10
+    assert results[0] == (None, "TimeoutError('no verdict after 1s')")
+    assert results[1][1] is None
+
+
+def test_large_queue_is_bounded(tmp_path):
+    large = tmp_path / 'large.pdf'
+    large.write_bytes(b'%PDF-' + b'0' * 1024)
+    pulled = []
+
+    def tasks():
+        for n in range(10):
+            pulled.append(n)
+            yield n, '01', str(large)
+
+    pool = SbcCheckPool(processes=2, large_size=1024, large_processes=1)
+    for num_results, _ in enumerate(pool.run(tasks()), 1):
+        # one file checking and at most one waiting for the large worker
+        assert len(pulled) <= num_results + 1
+
+    assert num_results == 10